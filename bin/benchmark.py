@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+
+"""
+Synthetic benchmarks for the verifier's parse, match and serialize stages.
+
+    benchmark.py generate DIR [--rows N] [--seed S] ...
+    benchmark.py run DIR [--save FILE] [--baseline FILE] [--repeat N] ...
+
+generate writes a restored files database of N rows to DIR/restored.db,
+with duplicate copies and filename collisions, plus one accession batch
+per inventory format in DIR/src (CSV with md5s, TSV, Windows dir and
+semicolon listings) and a config.yml for running the verifier on them.
+The same arguments always produce the same data.
+
+run times each stage on that data, reporting rows per second and the
+peak RSS of the process so far, and optionally saves the results or
+compares them with a saved baseline, exiting 1 on a regression.  Each
+stage is run five times by default and its fastest time kept.
+
+The benchmark imports the verifier package, so run it from the repository
+root with PYTHONPATH=. or with the package installed (pip install -e .).
+"""
+
+import argparse
+import json
+import os
+import random
+import resource
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+from verifier import accessions
+from verifier import verify
+from verifier.archiver import Package
+from verifier.restores import Database
+
+
+SQL_ROOT = os.path.join(os.path.dirname(os.path.abspath(accessions.__file__)),
+                        'db')
+
+# One accession batch is generated in each format DirList understands
+FORMATS = ['csv', 'tsv', 'windows', 'semicolon']
+
+FILENAMES = {'csv': 'csv_2020_bench.csv',
+             'tsv': 'tsv_2020_bench.tsv',
+             'windows': 'windows_2020_bench.txt',
+             'semicolon': 'semicolon_2020_bench.txt'}
+
+EXTENSIONS = ['tif', 'jpg', 'pdf', 'wav', 'xml', 'txt']
+
+TIMESTAMPS = [f'{month:02}/{day:02}/2003' for month in range(1, 13)
+              for day in (1, 15)]
+
+
+def human_rate(rows, seconds):
+    return f'{rows / seconds:,.0f} rows/s' if seconds else 'n/a'
+
+
+class Generator():
+    """
+    Deterministic generator of restored files and accession inventories.
+    Every restored file belongs to the batch of one format; a share of
+    them have a second copy on a retry tree, a share reuse the filename
+    of an earlier file with different bytes, and a sample of them are
+    listed in the batch's inventory along with a few files that were
+    never restored and a few altered ones.
+    """
+
+    def __init__(self, rows, seed=1, duplicates=0.05, collisions=0.1,
+                 sample=0.25, missing=0.01, altered=0.005):
+        self.rows = rows
+        self.random = random.Random(seed)
+        self.duplicates = duplicates
+        self.collisions = collisions
+        self.sample = sample
+        self.missing = missing
+        self.altered = altered
+        self.inventories = {format: [] for format in FORMATS}
+
+    def md5(self):
+        return f'{self.random.getrandbits(128):032x}'
+
+    def files(self):
+        """Yield rows for the files table, sampling the inventories."""
+        names = []
+        n = 0
+        while n < self.rows:
+            format = FORMATS[len(names) % len(FORMATS)]
+            if names and self.random.random() < self.collisions:
+                filename = self.random.choice(names)
+            else:
+                ext = EXTENSIONS[len(names) % len(EXTENSIONS)]
+                filename = f'{format}_{len(names):09}.{ext}'
+            names.append(filename)
+            bytes = self.random.randrange(1, 50000) * 1024
+            if format != 'semicolon':
+                bytes += self.random.randrange(1024)
+            md5 = self.md5()
+            subdir = f'{len(names) // 1000:05}'
+            copies = [f'/restored/{format}/batch/{subdir}/{filename}']
+            if self.random.random() < self.duplicates:
+                copies.append(f'/restored/retry/{format}/{filename}')
+            for path in copies:
+                n += 1
+                yield (f'bench-{n}', bytes, md5, filename, path, 1, n)
+            if self.random.random() < self.sample:
+                if self.random.random() < self.altered:
+                    md5 = self.md5()
+                self.inventories[format].append((filename, bytes, md5))
+                if self.random.random() < self.missing:
+                    self.inventories[format].append(
+                        (f'missing_{n}.tif', bytes, self.md5())
+                        )
+
+    def write_database(self, path):
+        if os.path.exists(path):
+            os.remove(path)
+        con = sqlite3.connect(path)
+        con.execute('PRAGMA journal_mode=OFF;')
+        con.execute('PRAGMA synchronous=OFF;')
+        with open(os.path.join(SQL_ROOT, 'schema.sql')) as handle:
+            con.executescript(handle.read())
+        con.execute("""INSERT INTO dirlists (id, md5, filename, share, batch)
+                        VALUES (1, '', 'bench.csv', 'bench', 'bench');""")
+        con.executemany(
+            """INSERT INTO files
+                (uuid, bytes, md5, filename, path, sourcefile, sourceline)
+               VALUES (?, ?, ?, ?, ?, ?, ?);""", self.files()
+            )
+        with open(os.path.join(SQL_ROOT, 'create_indexes.sql')) as handle:
+            con.executescript(handle.read())
+        con.commit()
+        con.close()
+
+    def lines(self, format):
+        """Yield the lines of the inventory in the given format."""
+        assets = self.inventories[format]
+        if format == 'csv':
+            yield 'Filename,Size,MD5'
+            for filename, bytes, md5 in assets:
+                yield f'{filename},{bytes},{md5}'
+        elif format == 'tsv':
+            yield 'File Name\tFile Size\tMod Date'
+            for n, (filename, bytes, md5) in enumerate(assets):
+                yield f'{filename}\t{bytes:,}\t{TIMESTAMPS[n % 24]}'
+        elif format == 'windows':
+            yield 'Volume in drive E is BENCH'
+            yield ' Directory of E:\\bench'
+            yield ''
+            for n, (filename, bytes, md5) in enumerate(assets):
+                yield f'{TIMESTAMPS[n % 24]}  01:15 PM {bytes:>17,} {filename}'
+        elif format == 'semicolon':
+            for n, (filename, bytes, md5) in enumerate(assets):
+                yield (f'E:\\bench\\{filename};{TIMESTAMPS[n % 24]} '
+                       f'1:02:03 PM;{bytes // 1024}')
+
+    def write_inventories(self, source_root):
+        if not os.path.exists(source_root):
+            os.makedirs(source_root)
+        for format in FORMATS:
+            path = os.path.join(source_root, FILENAMES[format])
+            with open(path, 'w') as handle:
+                for line in self.lines(format):
+                    handle.write(f'{line}\n')
+
+
+def generate(args):
+    root = os.path.abspath(args.dir)
+    generator = Generator(args.rows, seed=args.seed,
+                          duplicates=args.duplicates,
+                          collisions=args.collisions, sample=args.sample)
+    if not os.path.exists(root):
+        os.makedirs(root)
+    print(f'Generating {args.rows:,} restored files...')
+    start = time.perf_counter()
+    generator.write_database(os.path.join(root, 'restored.db'))
+    generator.write_inventories(os.path.join(root, 'src'))
+    for format in FORMATS:
+        print(f'  {format}: {len(generator.inventories[format]):,} assets')
+    with open(os.path.join(root, 'config.yml'), 'w') as handle:
+        handle.write(f'ROOTDIR: "{root}/"\n'
+                     f'SOURCEDIR: "src"\n'
+                     f'OUTPUTDIR: "out"\n'
+                     f'DATABASE: "restored.db"\n'
+                     f'EXCLUDES:\n'
+                     f'    - "Thumbs.db"\n')
+    print(f'Done in {time.perf_counter() - start:.1f}s')
+
+
+def peak_rss():
+    """Peak resident set size of this process so far, in KiB."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def timed(results, stage, rows, function, repeat):
+    """Run function repeat times, recording the best time for the stage."""
+    seconds = None
+    for n in range(repeat):
+        start = time.perf_counter()
+        value = function()
+        elapsed = time.perf_counter() - start
+        seconds = elapsed if seconds is None else min(seconds, elapsed)
+    if callable(rows):
+        rows = rows(value)
+    results[stage] = {'seconds': round(seconds, 4),
+                      'rows': rows,
+                      'rows_per_sec': round(rows / seconds) if seconds else None,
+                      'peak_rss_kib': peak_rss()}
+    print(f'  {stage:15} {seconds:9.3f}s {rows:>12,} rows  '
+          f'{human_rate(rows, seconds):>18}  '
+          f'peak RSS {results[stage]["peak_rss_kib"] // 1024:,} MiB')
+    return value
+
+
+def run(args):
+    root = os.path.abspath(args.dir)
+    source_root = os.path.join(root, 'src')
+    paths = {format: os.path.join(source_root, FILENAMES[format])
+             for format in FORMATS}
+    database_path = os.path.join(root, 'restored.db')
+    excludes = ['Thumbs.db']
+    results = {}
+    quiet = lambda message: None
+
+    print(f'Benchmarking {root}')
+    for format in FORMATS:
+        timed(results, f'parse-{format}', len,
+              lambda: accessions.DirList(paths[format]).assets, args.repeat)
+
+    def load():
+        return [accessions.Batch(format, accessions.DirList(paths[format]))
+                for format in FORMATS]
+    batches = timed(results, 'load', lambda b: sum(x.num_assets for x in b),
+                    load, args.repeat)
+    num_assets = sum(batch.num_assets for batch in batches)
+
+    database = Database(database_path, readonly=True)
+    timed(results, 'match-db', num_assets,
+          lambda: [database.match_batch(b.assets) for b in batches],
+          args.repeat)
+
+    def verify_all():
+        verified = load()
+        for batch in verified:
+            verify.verify_batch(batch, database, excludes, log=quiet)
+        return verified
+    batches = timed(results, 'verify', num_assets, verify_all, 1)
+
+    output = tempfile.mkdtemp(prefix='verifier-bench-')
+    try:
+        def serialize():
+            package = Package(output)
+            for batch in batches:
+                package.add(batch)
+            package.serialize_batches()
+        timed(results, 'serialize', num_assets, serialize, args.repeat)
+    finally:
+        shutil.rmtree(output)
+
+    if args.save:
+        with open(args.save, 'w') as handle:
+            json.dump(results, handle, indent=4, sort_keys=True)
+        print(f'Saved results to {args.save}')
+    if args.baseline:
+        return compare(results, args.baseline, args.tolerance, args.floor)
+    return 0
+
+
+def compare(results, path, tolerance, floor=0.005):
+    """
+    Print the change in time of each stage against a saved baseline and
+    return 1 if any stage is slower by more than tolerance percent and by
+    more than floor seconds, so that noise in stages taking a few
+    milliseconds is not counted.
+    """
+    with open(path) as handle:
+        baseline = json.load(handle)
+    print(f'Compared with {path}:')
+    regressions = 0
+    for stage, result in results.items():
+        if stage not in baseline:
+            continue
+        before = baseline[stage]['seconds']
+        change = (result['seconds'] - before) / before * 100 if before else 0
+        flag = ''
+        if change > tolerance and result['seconds'] - before > floor:
+            flag = '  REGRESSION'
+            regressions += 1
+        print(f'  {stage:15} {before:9.3f}s -> {result["seconds"]:9.3f}s '
+              f'{change:+7.1f}%{flag}')
+    return 1 if regressions else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+    gen = commands.add_parser('generate', help='generate synthetic data')
+    gen.add_argument('dir', help='directory to write the data to')
+    gen.add_argument('--rows', type=int, default=1000000,
+                     help='rows in the restored files database')
+    gen.add_argument('--seed', type=int, default=1)
+    gen.add_argument('--duplicates', type=float, default=0.05,
+                     help='share of restored files with a second copy')
+    gen.add_argument('--collisions', type=float, default=0.1,
+                     help='share of restored files reusing a filename')
+    gen.add_argument('--sample', type=float, default=0.25,
+                     help='share of restored files listed in inventories')
+    bench = commands.add_parser('run', help='time each stage')
+    bench.add_argument('dir', help='directory written by generate')
+    bench.add_argument('--repeat', type=int, default=5,
+                       help='runs of each stage, keeping the fastest')
+    bench.add_argument('--save', help='write the results to this JSON file')
+    bench.add_argument('--baseline', help='JSON results to compare with')
+    bench.add_argument('--tolerance', type=float, default=10.0,
+                       help='percent slowdown counted as a regression')
+    bench.add_argument('--floor', type=float, default=0.005,
+                       metavar='SECONDS',
+                       help='slowdown in seconds a stage must also exceed '
+                            'to count as a regression')
+    args = parser.parse_args()
+    if args.command == 'generate':
+        generate(args)
+    else:
+        sys.exit(run(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+import hashlib
+import pickle
+
+from verifier import accessions
+from verifier.accessions import DirList
+
+
+CSV = ('Filename,Size,MD5\n'
+       'a.tif,1024,0123456789abcdef0123456789abcdef\n'
+       'b.jpg,2048,fedcba9876543210fedcba9876543210\n'
+       '.DS_Store,6148,00000000000000000000000000000000\n')
+
+
+def asset_rows(dirlist):
+    return [(a.filename, a.bytes, a.md5, a.sourcefile, a.sourceline)
+            for a in dirlist.assets]
+
+
+def test_mapped_dirlist_matches_text_parser(tmp_path, monkeypatch):
+    path = tmp_path / 'batch_2020_inventory.csv'
+    path.write_text(CSV)
+    text = DirList(str(path))
+    monkeypatch.setattr(accessions, 'MMAP_THRESHOLD', 0)
+    mapped = DirList(str(path))
+    assert text.mapped is None and mapped.mapped is not None
+    assert mapped.lines is None
+    assert mapped.md5 == text.md5
+    assert mapped.line_count == text.line_count == 4
+    assert asset_rows(mapped) == asset_rows(text)
+    assert asset_rows(text)[0] == ('a.tif', 1024,
+                                   '0123456789abcdef0123456789abcdef',
+                                   'batch_2020_inventory.csv', 0)
+
+
+def test_mapped_scan_checks_counts_and_hashes_in_chunks(tmp_path,
+                                                        monkeypatch):
+    path = tmp_path / 'batch_2020_inventory.csv'
+    path.write_text(CSV)
+    monkeypatch.setattr(accessions, 'MMAP_CHUNK_SIZE', 7)
+    mapped = accessions.MappedInventory.scan(str(path))
+    assert mapped.line_count == 4
+    assert mapped.md5 == hashlib.md5(CSV.encode('ascii')).hexdigest()
+    assert accessions.MappedInventory.scan(str(path), md5='known').md5 == \
+        'known'
+
+    # a non-ASCII byte anywhere rules out the byte-level reader
+    path.write_text(CSV + 'c\u00e9.tif,1,00000000000000000000000000000000\n')
+    assert accessions.MappedInventory.scan(str(path)) is None
+
+
+def test_released_dirlist_keeps_line_count(tmp_path, monkeypatch):
+    path = tmp_path / 'batch_2020_inventory.csv'
+    path.write_text(CSV)
+    monkeypatch.setattr(accessions, 'MMAP_THRESHOLD', 0)
+    dirlist = DirList(str(path))
+    dirlist.assets
+    dirlist.release()
+    assert dirlist.line_count == 4
+
+
+def test_sniff_parser_picks_each_format():
+    assert isinstance(accessions.sniff_parser('Volume in drive E is X'),
+                      accessions.WindowsDirParser)
+    assert isinstance(accessions.sniff_parser(
+        'E:\\x\\a.tif;01/02/2003 1:02:03 PM;12'), accessions.SemicolonParser)
+    assert accessions.sniff_parser('Filename,Size,MD5') is \
+        accessions.DEFAULT_PARSER
+    assert accessions.sniff_parser('File Name\tFile Size\tMod Date') is \
+        accessions.DEFAULT_PARSER
+
+
+def test_registered_parser_is_consulted(monkeypatch):
+    monkeypatch.setattr(accessions, 'PARSERS', list(accessions.PARSERS))
+
+    @accessions.register_parser
+    class BangParser(accessions.DirListParser):
+        def sniff(self, head):
+            return head.startswith('!')
+
+        def iter_assets(self, lines, sourcefile):
+            for n, line in enumerate(lines):
+                if not line.startswith('!'):
+                    yield accessions.Asset(line, sourcefile, n)
+
+    parser = accessions.sniff_parser('!listing')
+    assert isinstance(parser, BangParser)
+    assets = list(parser.iter_assets(['!listing', 'a.tif'], 'x.txt'))
+    assert [(a.filename, a.sourceline) for a in assets] == [('a.tif', 1)]
+
+
+def test_each_format_parses(tmp_path):
+    listings = {
+        'windows_2020_x.txt': ' Volume in drive E is X\n'
+                              ' Directory of E:\\x\n\n'
+                              '01/02/2003  01:15 PM          1,024 a.tif\n',
+        'semicolon_2020_x.txt': 'E:\\x\\a.tif;01/02/2003 1:02:03 PM;1\n'
+                                'E:\\x\\sub;01/02/2003 1:02:03 PM;Directory\n',
+        'tsv_2020_x.tsv': 'File Name\tFile Size\tMod Date\n'
+                          'a.tif\t1,024\t01/02/2003\n',
+        }
+    for name, text in listings.items():
+        path = tmp_path / name
+        path.write_text(text)
+        assets = DirList(str(path)).assets
+        assert [(a.filename, a.bytes) for a in assets] == [('a.tif', 1024)]
+
+
+def test_slotted_asset_survives_pickling():
+    asset = accessions.Asset('a.tif', 'a_2020_x.csv', 3, bytes=1024,
+                             md5='0123456789abcdef0123456789abcdef')
+    assert not hasattr(asset, '__dict__')
+    assert asset.duplicates == () and asset.extra_copies == ()
+    copy = pickle.loads(pickle.dumps(asset))
+    assert ((copy.filename, copy.bytes, copy.md5, copy.sourceline,
+             copy.restored, copy.duplicates) ==
+            ('a.tif', 1024, asset.md5, 3, None, ()))
+
+
+def test_batch_statistics_match_a_full_scan(tmp_path):
+    for name, text in [('stats_2020_a.csv', CSV),
+                       ('stats_2020_b.csv', 'Filename,Size,MD5\n'
+                                            'a.tif,1024,0123456789abcdef'
+                                            '0123456789abcdef\n'
+                                            'c.tif,,\n')]:
+        (tmp_path / name).write_text(text)
+    paths = sorted(str(p) for p in tmp_path.iterdir())
+    batch = accessions.Batch('stats', *[DirList(p) for p in paths])
+    streamed = accessions.Batch('stats', *[DirList(p, stream=True)
+                                           for p in paths], stream=True)
+    streamed_assets = list(streamed.iter_assets())
+    for asset in batch.assets[::2]:
+        batch.classify(asset, 'Found')
+
+    assets = batch.assets
+    assert batch.num_assets == streamed.num_assets == len(assets) == 5
+    assert batch.bytes == streamed.bytes == \
+        sum(a.bytes for a in assets if a.bytes is not None)
+    assert batch.unhashed == streamed.unhashed == \
+        sum(a.md5 is None for a in assets)
+    assert dict(batch.statuses) == {'Found': 3, 'Not checked': 2}
+    assert batch.all_have_status('Found') is False
+    # a.tif is listed twice with the same size and md5
+    assert batch.has_duplicates()
+    assert [a.filename for a in streamed_assets] == \
+        [a.filename for a in assets]
@@ -0,0 +1,92 @@
+import os
+
+import yaml
+
+from verifier import archiver
+from verifier.accessions import Asset
+from verifier.accessions import Batch
+from verifier.archiver import CheckpointStore
+from verifier.archiver import Package
+from verifier.restores import RestoredAsset
+
+
+def test_checkpoints_invalidated_by_dirlists_excludes_and_database(tmp_path):
+    database = tmp_path / 'restored.db'
+    database.write_bytes(b'db')
+    dirlist = tmp_path / 'test_2020_list.csv'
+    dirlist.write_text('Filename\na.tif\n')
+    item = ('test', [str(dirlist)], {}, ['Thumbs.db'], None, False)
+    root = str(tmp_path / 'package')
+
+    store = CheckpointStore(root, str(database))
+    assert store.load(item) is None
+    store.save(item, 'batch', True, ['message'])
+    assert store.load(item) == ('batch', True, ['message'])
+
+    # the exclude patterns are part of the key
+    assert store.load(item[:3] + (['.DS_Store'],) + item[4:]) is None
+
+    # so is the restored files database, read when the store is made
+    database.write_bytes(b'changed db')
+    assert CheckpointStore(root, str(database)).load(item) is None
+
+    # and so are the dirlists, by size, mtime and inode
+    store = CheckpointStore(root, str(database))
+    store.save(item, 'batch', True, [])
+    stat = os.stat(dirlist)
+    os.utime(dirlist, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000))
+    assert store.load(item) is None
+
+
+def test_checkpoints_invalidated_by_format(tmp_path, monkeypatch):
+    database = tmp_path / 'restored.db'
+    database.write_bytes(b'db')
+    dirlist = tmp_path / 'test_2020_list.csv'
+    dirlist.write_text('Filename\na.tif\n')
+    item = ('test', [str(dirlist)], {}, [], None, False)
+    store = CheckpointStore(str(tmp_path / 'package'), str(database))
+    store.save(item, 'batch', True, [])
+    assert store.is_current(item)
+
+    monkeypatch.setattr(archiver, 'CHECKPOINT_FORMAT',
+                        archiver.CHECKPOINT_FORMAT + 1)
+    assert not store.is_current(item)
+    assert store.load(item) is None
+
+
+def test_package_writes_every_batch_whole(tmp_path):
+    package = Package(str(tmp_path / 'package'))
+    for name in ['alpha', 'beta', 'gamma']:
+        batch = Batch(name)
+        for n in range(3):
+            asset = Asset(f'{name}{n}.tif', f'{name}_2020_list.csv', n,
+                          bytes=n, md5=f'md5{n}')
+            batch.count(asset)
+            batch.assets.append(asset)
+            batch.classify(asset, 'Found')
+            batch.restore(asset, RestoredAsset(f'{name}-{n}', n, f'md5{n}',
+                                               asset.filename,
+                                               f'/r/{name}/{asset.filename}'))
+        batch.assets[0].extra_copies = [
+            RestoredAsset(f'{name}-x', 0, 'md50', f'{name}0.tif',
+                          f'/r/other/{name}0.tif')
+            ]
+        package.add(batch)
+    package.serialize_batches(workers=3)
+
+    for name in ['alpha', 'beta', 'gamma']:
+        batch_path = tmp_path / 'package' / 'batches' / name
+        assert sorted(os.listdir(batch_path)) == \
+            ['deaccessions.txt', 'manifest.txt', 'missing.txt']
+        assert (batch_path / 'manifest.txt').read_text() == ''.join(
+            f'md5{n} /r/{name}/{name}{n}.tif\n' for n in range(3)
+            )
+        assert (batch_path / 'deaccessions.txt').read_text() == \
+            f'duplicate md50 /r/other/{name}0.tif\n'
+        assert (batch_path / 'missing.txt').read_text() == ''
+    master = tmp_path / 'package' / 'batches.yml'
+    batches = yaml.safe_load(master.read_text())
+    assert [(b['path'], b['asset_root']) for b in batches['batches']] == \
+        [(name, f'/r/{name}') for name in ['alpha', 'beta', 'gamma']]
+    assert sorted(os.listdir(tmp_path / 'package')) == ['batches',
+                                                         'batches.yml']
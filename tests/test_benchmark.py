@@ -0,0 +1,32 @@
+import importlib.util
+import json
+import os
+
+
+BENCHMARK = os.path.join(os.path.dirname(os.path.dirname(__file__)),
+                         'bin', 'benchmark.py')
+
+
+def load_benchmark():
+    spec = importlib.util.spec_from_file_location('benchmark', BENCHMARK)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def test_compare_ignores_small_and_short_slowdowns(tmp_path, capsys):
+    benchmark = load_benchmark()
+    baseline = tmp_path / 'baseline.json'
+    baseline.write_text(json.dumps({
+        'parse':     {'seconds': 2.0},
+        'serialize': {'seconds': 0.002},
+        }))
+    # 5% slower, and 50% slower but by only a millisecond
+    results = {'parse': {'seconds': 2.1}, 'serialize': {'seconds': 0.003}}
+    assert benchmark.compare(results, str(baseline), 10.0) == 0
+    # 20% slower by 0.4 seconds
+    results['parse']['seconds'] = 2.4
+    assert benchmark.compare(results, str(baseline), 10.0) == 1
+    assert 'parse' in [line.split()[0] for line in
+                       capsys.readouterr().out.splitlines()
+                       if line.endswith('REGRESSION')]
@@ -0,0 +1,62 @@
+import os
+import sqlite3
+import sys
+
+import pytest
+
+from verifier import load_accessions_db
+from verifier.restores import Database
+
+
+SQL_ROOT = os.path.join(os.path.dirname(os.path.dirname(__file__)),
+                        'verifier', 'db')
+
+
+def make_accessions(tmp_path):
+    """Two batches of dirlists and an empty accessions database."""
+    source = tmp_path / 'src'
+    source.mkdir()
+    for batch in ['alpha', 'beta']:
+        (source / f'{batch}_2020_list.csv').write_text(
+            'Filename,Size,MD5\n'
+            f'{batch}1.tif,1,{"1" * 32}\n'
+            f'{batch}2.tif,2,{"2" * 32}\n'
+            )
+    connection = sqlite3.connect(str(tmp_path / 'acc.db'))
+    with open(os.path.join(SQL_ROOT, 'patsy.sql')) as handle:
+        connection.executescript(handle.read())
+    connection.close()
+    config = tmp_path / 'config.yml'
+    config.write_text(f'ROOTDIR: "{tmp_path}/"\n'
+                      'SOURCEDIR: "src"\n'
+                      'DATABASE: "acc.db"\n')
+    return str(config)
+
+
+def table(tmp_path, query):
+    connection = sqlite3.connect(str(tmp_path / 'acc.db'))
+    rows = connection.execute(query).fetchall()
+    connection.close()
+    return rows
+
+
+def test_failed_batch_leaves_nothing_behind(tmp_path, monkeypatch):
+    config = make_accessions(tmp_path)
+    create_assets = Database.create_assets
+
+    def failing_create_assets(self, rows):
+        rows = list(rows)
+        if rows[0][0].startswith('beta'):
+            raise RuntimeError('disk full')
+        create_assets(self, rows)
+
+    monkeypatch.setattr(Database, 'create_assets', failing_create_assets)
+    monkeypatch.setattr(sys, 'argv', ['load_accessions_db', config])
+    with pytest.raises(RuntimeError):
+        load_accessions_db.main()
+
+    assert table(tmp_path, 'SELECT name FROM batches;') == [('alpha',)]
+    assert table(tmp_path, 'SELECT filename FROM dirlists;') == \
+        [('alpha_2020_list.csv',)]
+    assert table(tmp_path, 'SELECT filename, source_line FROM assets;') == \
+        [('alpha1.tif', 0), ('alpha2.tif', 1)]
@@ -0,0 +1,100 @@
+import os
+import sqlite3
+
+from verifier.db import load_restored_files_db as loader
+
+
+SQL_ROOT = os.path.dirname(loader.__file__)
+
+
+def make_search_root(root):
+    """Create an empty directory for each share under root."""
+    for share in loader.shares:
+        os.makedirs(os.path.join(root, share['share']))
+
+
+def write_list(root, name, batch, rows):
+    share = [s for s in loader.shares if s['name'] == name][0]
+    path = os.path.join(root, share['share'],
+                        f"{share['prefix']}{batch}{share['suffix']}")
+    with open(path, 'w') as handle:
+        for md5, filepath, filename, bytes in rows:
+            handle.write(f'{md5},{filepath},{filename},{bytes}\n')
+    return path
+
+
+def make_database(path):
+    connection = sqlite3.connect(path)
+    with open(os.path.join(SQL_ROOT, 'schema.sql')) as handle:
+        connection.executescript(handle.read())
+    connection.close()
+
+
+def counts(path):
+    connection = sqlite3.connect(path)
+    result = tuple(
+        connection.execute(f'SELECT count(*) FROM {table};').fetchone()[0]
+        for table in ('files', 'dirlists')
+        )
+    connection.close()
+    return result
+
+
+def test_bulk_reload_replaces_loaded_lists(tmp_path, monkeypatch):
+    root = str(tmp_path / 'restored')
+    make_search_root(root)
+    write_list(root, 'henson', 'batch_a', [
+        ('m1', '/r/a/1.tif', '1.tif', 10), ('m2', '/r/a/2.tif', '2.tif', 20)
+        ])
+    write_list(root, 'prange', 'General batch_b', [
+        ('m3', '/r/b/3.tif', '3.tif', 30)
+        ])
+    monkeypatch.setattr(loader, 'SEARCH_ROOT', root)
+    db = str(tmp_path / 'restored.db')
+    make_database(db)
+
+    loader.main([db, '--bulk'])
+    assert counts(db) == (3, 2)
+    loader.main([db, '--bulk'])
+    assert counts(db) == (3, 2)
+
+    # an incremental load afterwards finds nothing to replace
+    loader.main([db, '--incremental'])
+    assert counts(db) == (3, 2)
+
+
+def test_incremental_load_replaces_changed_lists_per_share(tmp_path,
+                                                           monkeypatch):
+    root = str(tmp_path / 'restored')
+    make_search_root(root)
+    rows = [('m1', '/r/a/1.tif', '1.tif', 10)]
+    changed = write_list(root, 'henson', 'batch_a', rows)
+    write_list(root, 'prange', 'General batch_b', [
+        ('m3', '/r/b/3.tif', '3.tif', 30)
+        ])
+    monkeypatch.setattr(loader, 'SEARCH_ROOT', root)
+    db = str(tmp_path / 'restored.db')
+    make_database(db)
+    loader.main([db])
+    assert counts(db) == (2, 2)
+
+    # a changed list is replaced, and a list with the same contents as one
+    # loaded for another share is still loaded for its own
+    write_list(root, 'henson', 'batch_a',
+               rows + [('m2', '/r/a/2.tif', '2.tif', 20)])
+    write_list(root, 'football', 'batch_c', rows)
+    loader.main([db, '--incremental'])
+    assert counts(db) == (4, 3)
+    connection = sqlite3.connect(db)
+    lists = connection.execute(
+        'SELECT share, filename FROM dirlists ORDER BY share;'
+        ).fetchall()
+    connection.close()
+    assert [share for share, filename in lists] == \
+        ['football', 'henson', 'prange']
+    assert os.path.basename(changed) in [f for s, f in lists]
+
+    # the hashes of unchanged lists are taken from the default hash cache
+    assert os.path.exists(tmp_path / 'hashes.db')
+    loader.main([db, '--incremental'])
+    assert counts(db) == (4, 3)
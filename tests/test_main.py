@@ -0,0 +1,109 @@
+import sqlite3
+
+from verifier.__main__ import find_batches
+from verifier.__main__ import select_batches
+from verifier.__main__ import verify_all
+from verifier.archiver import CheckpointStore
+from verifier.metrics import METRICS
+
+
+BATCHES = {'alpha': ['a'], 'beta': ['b1', 'b2'], 'betamax': ['c'],
+           'gamma': ['g']}
+
+
+def test_select_batches_by_name_and_glob():
+    assert select_batches(BATCHES) == BATCHES
+    assert list(select_batches(BATCHES, names=['beta'])) == ['beta']
+    assert sorted(select_batches(BATCHES, pattern='beta*')) == \
+        ['beta', 'betamax']
+    assert sorted(select_batches(BATCHES, names=['gamma'],
+                                 pattern='al*')) == ['alpha', 'gamma']
+    # glob matching is case sensitive, as batch names are
+    assert select_batches(BATCHES, pattern='Beta*') == {}
+    assert select_batches(BATCHES, names=['delta']) == {}
+
+
+def test_find_batches_groups_dirlists(tmp_path):
+    for name in ['beta_2020_a.tsv', 'beta_2021_b.tsv', 'alpha_2020_a.csv']:
+        (tmp_path / name).write_text('')
+    batches = find_batches(str(tmp_path))
+    assert sorted(batches) == ['alpha', 'beta']
+    assert sorted(p.rsplit('/', 1)[-1] for p in batches['beta']) == \
+        ['beta_2020_a.tsv', 'beta_2021_b.tsv']
+
+
+def test_checkpoints_are_loaded_as_their_items_come_up(tmp_path, monkeypatch):
+    database = tmp_path / 'restored.db'
+    database.write_bytes(b'db')
+    store = CheckpointStore(str(tmp_path / 'package'), str(database))
+    work = []
+    for name in ['alpha', 'beta']:
+        dirlist = tmp_path / f'{name}_2020_list.csv'
+        dirlist.write_text('Filename\na.tif\n')
+        item = (name, [str(dirlist)], {}, [], None, False)
+        store.save(item, f'{name} batch', True, [])
+        work.append(item)
+
+    loaded = []
+    load = store.load
+    monkeypatch.setattr(store, 'load',
+                        lambda item: loaded.append(item[0]) or load(item))
+    METRICS.reset()
+    results = verify_all(work, 1, str(database), False, store)
+    assert next(results) == ('alpha batch', True)
+    assert loaded == ['alpha']
+    assert list(results) == [('beta batch', True)]
+    assert loaded == ['alpha', 'beta']
+    assert METRICS.stages['checkpoint']['items'] == 2
+
+    # without checkpoints there is no checkpoint stage to record
+    METRICS.reset()
+    assert list(verify_all([], 1, str(database), False, None)) == []
+    assert 'checkpoint' not in METRICS.stages
+
+
+def make_verify_fixture(tmp_path):
+    """A restored files database and three small batches to verify."""
+    database = str(tmp_path / 'restored.db')
+    connection = sqlite3.connect(database)
+    connection.execute(
+        """CREATE TABLE files (uuid TEXT, bytes INTEGER, md5 TEXT,
+                               filename TEXT, path TEXT);"""
+        )
+    rows = []
+    work = []
+    for batch in ['alpha', 'beta', 'gamma']:
+        dirlist = tmp_path / f'{batch}_2020_list.csv'
+        lines = ['Filename,Size,MD5']
+        for n in range(4):
+            md5 = f'{batch}{n}'.ljust(32, '0')
+            lines.append(f'{batch}{n}.tif,{n + 1},{md5}')
+            rows.append((f'{batch}-{n}', n + 1, md5, f'{batch}{n}.tif',
+                         f'/r/{batch}/{batch}{n}.tif'))
+        dirlist.write_text('\n'.join(lines) + '\n')
+        work.append((batch, [str(dirlist)], {}, ['Thumbs.db'], None, False))
+    # beta's second file has a second copy, gamma's last is missing
+    rows.append(('beta-1b', 2, 'beta1'.ljust(32, '0'), 'beta1.tif',
+                 '/r/other/beta1.tif'))
+    rows = [r for r in rows if r[0] != 'gamma-3']
+    connection.executemany('INSERT INTO files VALUES (?, ?, ?, ?, ?);', rows)
+    connection.commit()
+    connection.close()
+    return work, database
+
+
+def summary(results):
+    return [(batch.identifier, complete, dict(batch.statuses),
+             [(a.filename, a.restored.path if a.restored else None)
+              for a in batch.assets])
+            for batch, complete in results]
+
+
+def test_parallel_verification_matches_serial(tmp_path):
+    work, database = make_verify_fixture(tmp_path)
+    serial = summary(verify_all(work, 1, database, False))
+    assert [complete for name, complete, statuses, assets in serial] == \
+        [True, True, False]
+    assert serial[1][3][1] == ('beta1.tif', '/r/beta/beta1.tif')
+    assert summary(verify_all(work, 3, database, False)) == serial
+    assert summary(verify_all(work, 2, database, True)) == serial
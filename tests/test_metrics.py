@@ -0,0 +1,23 @@
+from verifier.metrics import Metrics
+
+
+def test_stages_and_calls_merge_across_processes():
+    parent, worker = Metrics(), Metrics()
+    with parent.stage('parse', items=3):
+        pass
+    worker.add('parse', 0.5, 7)
+    worker.add('match', 0.25, 7)
+    worker.observe('Database.match_batch', 0.000003)
+    worker.observe('Database.match_batch', 0.001)
+    parent.merge(worker)
+
+    metrics = parent.as_dict()
+    assert metrics['stages']['parse']['items'] == 10
+    assert metrics['stages']['parse']['seconds'] >= 0.5
+    assert metrics['stages']['match'] == {'seconds': 0.25, 'items': 7,
+                                          'items_per_sec': 28}
+    call = metrics['calls']['Database.match_batch']
+    assert call['count'] == 2
+    assert call['max_us'] == 1000.0
+    # buckets are the powers of two bounding each latency in microseconds
+    assert call['histogram_us'] == [(4, 1), (1024, 1)]
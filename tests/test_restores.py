@@ -0,0 +1,196 @@
+import os
+import sqlite3
+
+import pytest
+
+from verifier.accessions import Asset
+from verifier.restores import Database
+from verifier.restores import INDEXES
+from verifier.restores import MatchIndex
+
+
+SQL_ROOT = os.path.join(os.path.dirname(os.path.dirname(__file__)),
+                        'verifier', 'db')
+
+
+def make_database(path, script):
+    connection = sqlite3.connect(path)
+    with open(os.path.join(SQL_ROOT, script)) as handle:
+        connection.executescript(handle.read())
+    connection.commit()
+    connection.close()
+    return Database(path)
+
+
+RESTORED = [
+    ('u1', 10, 'm1', 'a.tif', '/r/x/a.tif'),
+    ('u2', 10, 'm2', 'a.tif', '/r/y/a.tif'),
+    ('u3', 11, 'm3', 'a.tif', '/r/z/a.tif'),
+    ('u4', 20, 'm4', 'b.tif', '/r/x/b.tif'),
+    ]
+
+
+def make_restored_database(path):
+    database = make_database(path, 'schema.sql')
+    with database.connection:
+        database.cursor.executemany(
+            """INSERT INTO files (uuid, bytes, md5, filename, path)
+                VALUES (?, ?, ?, ?, ?);""", RESTORED
+            )
+    return database
+
+
+def match_assets():
+    return [Asset('a.tif', 'l.csv', 0, bytes=10, md5='m1'),
+            Asset('a.tif', 'l.csv', 1),
+            Asset('b.tif', 'l.csv', 2, bytes=21),
+            Asset('c.tif', 'l.csv', 3),
+            Asset('b.tif', 'l.csv', 4, bytes=20, md5='other')]
+
+
+def test_match_batch_agrees_with_per_asset_queries(tmp_path):
+    database = make_restored_database(str(tmp_path / 'restored.db'))
+    assets = match_assets()
+    expected = [database.match_filename(asset) if asset.bytes is None
+                else database.match_filename_bytes(asset)
+                for asset in assets]
+    assert database.match_batch(assets) == expected
+    assert [[m.id for m in matches] if matches else None
+            for matches in expected] == \
+        [['u1', 'u2'], ['u1', 'u2', 'u3'], None, None, ['u4']]
+    # the signature table is left empty for the next batch
+    assert database.match_batch([]) == []
+
+
+def test_record_instance_actions(tmp_path):
+    database = make_database(str(tmp_path / 'accessions.db'), 'patsy.sql')
+    database.cursor.executemany(
+        """INSERT INTO dirlists (id, filename) VALUES (?, ?);""",
+        [(1, 'a_2020_list.csv'), (2, 'b_2020_list.csv')]
+        )
+    database.cursor.executemany(
+        """INSERT INTO instances (uuid, dirlist_id, dirlist_line)
+            VALUES (?, ?, ?);""",
+        [('i1', 1, 0), ('i2', 1, 1), ('i3', 2, 0), ('i4', 2, 1)]
+        )
+    database.create_instance_indexes()
+    with database.connection:
+        database.record_instance_actions([
+            ('a_2020_list.csv', 0, 'perfect'),
+            ('a_2020_list.csv', 1, 'missing'),
+            ('a_2020_list.csv', 1, 'altered'),
+            ('b_2020_list.csv', 1, 'discard'),
+            ('unknown.csv', 0, 'perfect'),
+            ])
+    actions = dict(database.cursor.execute(
+        """SELECT uuid, action FROM instances;"""
+        ))
+    assert actions == {'i1': 'perfect', 'i2': 'altered', 'i3': None,
+                       'i4': 'discard'}
+
+
+def test_record_file_actions(tmp_path):
+    database = make_database(str(tmp_path / 'restored.db'), 'schema.sql')
+    database.cursor.executemany(
+        """INSERT INTO files (uuid, filename, action) VALUES (?, ?, ?);""",
+        [('a', 'a.tif', 'stale'), ('b', 'b.tif', None), ('c', 'c.tif', None),
+         ('d', 'd.tif', None), ('e', 'Thumbs.db', None),
+         ('f', '.DS_Store', None)]
+        )
+    with database.connection:
+        database.clear_file_actions()
+        database.record_file_actions([
+            ('a', 'duplicate'), ('a', 'transfer'), ('a', 'altered'),
+            ('b', 'duplicate'), ('b', 'altered'),
+            ])
+        database.record_unmatched_actions(['Thumbs.db'])
+    actions = dict(database.cursor.execute(
+        """SELECT uuid, action FROM files;"""
+        ))
+    assert actions == {'a': 'transfer', 'b': 'altered', 'c': 'x-file',
+                       'd': 'x-file', 'e': 'discard', 'f': 'discard'}
+
+
+def test_record_file_actions_across_batches(tmp_path):
+    database = make_database(str(tmp_path / 'restored.db'), 'schema.sql')
+    database.cursor.executemany(
+        """INSERT INTO files (uuid, filename, action) VALUES (?, ?, ?);""",
+        [('x', 'x.tif', 'x-file'), ('y', 'y.tif', None), ('z', 'z.tif', None)]
+        )
+    with database.connection:
+        # alpha transfers x and finds y altered
+        database.record_file_actions([('x', 'transfer'), ('y', 'altered')])
+        # beta only has duplicates of x and y, but transfers z
+        database.record_file_actions([
+            ('x', 'duplicate'), ('y', 'duplicate'), ('z', 'transfer')
+            ])
+        # gamma transfers the copy alpha found altered
+        database.record_file_actions([('y', 'transfer')])
+    actions = dict(database.cursor.execute(
+        """SELECT uuid, action FROM files;"""
+        ))
+    assert actions == {'x': 'transfer', 'y': 'transfer', 'z': 'transfer'}
+
+
+def test_unmatched_files_leave_out_discards(tmp_path):
+    database = make_database(str(tmp_path / 'restored.db'), 'schema.sql')
+    database.cursor.execute(
+        """INSERT INTO dirlists (id, filename, share, batch)
+            VALUES (1, 'list.csv', 'share', 'batch');"""
+        )
+    database.cursor.executemany(
+        """INSERT INTO files (uuid, bytes, filename, path, sourcefile)
+            VALUES (?, ?, ?, ?, 1);""",
+        [('a', 1, 'a.tif', '/r/a.tif'), ('b', 2, 'b.tif', '/r/b.tif'),
+         ('c', 3, 'Thumbs.db', '/r/Thumbs.db'),
+         ('d', 4, '.DS_Store', '/r/.DS_Store')]
+        )
+    database.add_matched_files(['a'])
+    rows = list(database.unmatched_files(['Thumbs.db']))
+    assert rows == [('share', 'batch', None, 2, '/r/b.tif')]
+
+
+def test_match_index_agrees_with_database(tmp_path):
+    path = str(tmp_path / 'restored.db')
+    database = make_restored_database(path)
+    index = MatchIndex.from_database(path)
+    assets = match_assets()
+    assert index.match_batch(assets) == database.match_batch(assets)
+    for asset in assets:
+        assert (index.match_filename_bytes_md5(asset) ==
+                database.match_filename_bytes_md5(asset))
+
+
+def test_read_only_connections_share_the_database_with_a_writer(tmp_path):
+    path = str(tmp_path / 'restored.db')
+    writer = make_restored_database(path)
+    assert writer.cursor.execute('PRAGMA journal_mode;').fetchone() == \
+        ('wal',)
+    reader = Database(path, readonly=True)
+    with pytest.raises(sqlite3.OperationalError):
+        reader.cursor.execute("DELETE FROM files;")
+
+    # WAL lets the reader carry on while a write is in progress
+    writer.cursor.execute("DELETE FROM files WHERE uuid='u4';")
+    assert len(reader.match_batch(match_assets())[4]) == 1
+    writer.connection.commit()
+    assert reader.match_batch(match_assets())[4] is None
+
+
+def test_check_indexes_reports_and_repairs_lookup_indexes(tmp_path):
+    database = make_restored_database(str(tmp_path / 'restored.db'))
+    database.drop_indexes(INDEXES)
+    warnings = database.check_indexes()
+    assert sorted(w.split()[2] for w in warnings
+                  if w.startswith('Missing')) == sorted(INDEXES)
+    # without the lookup indexes the match queries scan the files table
+    assert any(w.startswith('match_filename_bytes_md5 scans')
+               for w in warnings)
+
+    database.cursor.execute("CREATE INDEX filename_lookup on files(filename);")
+    assert any(w.startswith('Redundant index filename_lookup')
+               for w in database.check_indexes())
+
+    assert database.check_indexes(create=True) == []
+    assert database.index_names() >= set(INDEXES)
+    assert 'filename_lookup' not in database.index_names()
@@ -0,0 +1,47 @@
+import importlib
+import os
+
+import pytest
+
+
+SHELVER = os.path.join(os.path.dirname(os.path.dirname(__file__)),
+                       'verifier', 'shelver')
+
+TSV = ('File Name\tExt\tFile Size\tPath\tMod Date\tType\tMD5\tSHA1\n'
+       'a.tif\ttif\t100\tbooks/x\t01/01/2010\tFile\tmd5a\tsha1a\n'
+       'x\t\t\tbooks\t01/01/2010\tDirectory\t\t\n')
+
+
+@pytest.fixture
+def classes(monkeypatch):
+    """The shelver's classes module, which imports its siblings by name."""
+    monkeypatch.syspath_prepend(SHELVER)
+    return importlib.import_module('classes')
+
+
+def test_inventory_cache_parses_each_version_once(tmp_path, classes,
+                                                  monkeypatch):
+    inventory = tmp_path / 'prange_inv.txt'
+    inventory.write_text(TSV)
+    parsed = []
+    init = classes.InventoryFile.__init__
+
+    def counting_init(self, path, md5=None):
+        parsed.append(path)
+        init(self, path, md5)
+
+    monkeypatch.setattr(classes.InventoryFile, '__init__', counting_init)
+    with classes.InventoryCache(str(tmp_path / 'cache')) as cache:
+        first = cache.load(str(inventory))
+        second = cache.load(str(inventory))
+        assert len(parsed) == 1
+        assert second.md5 == first.md5
+        assert ([a.filename for a in second.accessions] ==
+                [a.filename for a in first.accessions] == ['a.tif'])
+
+        inventory.write_text(TSV.replace('a.tif', 'ab.tif'))
+        third = cache.load(str(inventory))
+        assert len(parsed) == 2
+        assert [a.filename for a in third.accessions] == ['ab.tif']
+        keys = [k for k in cache.shelf.keys() if k.startswith('md5:')]
+        assert keys == [f'md5:{third.md5}']
@@ -0,0 +1,116 @@
+import csv
+import os
+import time
+
+import pytest
+
+from verifier.utils import HashCache
+from verifier.utils import LineReader
+from verifier.utils import atomic_write
+from verifier.utils import calculate_md5
+from verifier.utils import hash_files
+from verifier.utils import prefetch
+from verifier.utils import read_text
+
+
+def write(tmp_path, data):
+    path = tmp_path / 'inventory.txt'
+    path.write_bytes(data)
+    return str(path)
+
+
+def test_line_reader_decodes_like_read_text(tmp_path):
+    # valid utf-8 on the first line, but not in the file as a whole
+    path = write(tmp_path, 'café.tif\n'.encode('utf8') +
+                           'naïve.tif\r\n'.encode('iso-8859-1'))
+    md5, handle, encoding = read_text(path)
+    reader = LineReader(path)
+    assert list(reader) == [line.strip() for line in handle]
+    assert reader.encoding == encoding == 'iso-8859-1'
+    assert reader.md5 == md5 == calculate_md5(path)
+    assert reader.lines == 2
+
+
+def test_line_reader_keeps_known_md5(tmp_path):
+    path = write(tmp_path, 'café.tif\n'.encode('utf8'))
+    reader = LineReader(path, md5='known')
+    assert list(reader) == ['café.tif']
+    assert reader.encoding == 'utf8'
+    assert reader.md5 == 'known'
+
+
+def test_line_reader_fails_whole_file(tmp_path):
+    path = write(tmp_path, b'ok.tif\n\xff.tif\n')
+    reader = LineReader(path, encodings=('utf8',))
+    try:
+        next(iter(reader))
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('expected ValueError before the first line')
+
+
+def test_atomic_write_keeps_csv_line_endings_and_cleans_up(tmp_path):
+    path = tmp_path / 'xfiles.csv'
+    with atomic_write(str(path), newline='') as handle:
+        csv.writer(handle).writerow(['share', 'batch'])
+    assert path.read_bytes() == b'share,batch\r\n'
+
+    with pytest.raises(RuntimeError):
+        with atomic_write(str(path), newline='') as handle:
+            handle.write('partial')
+            raise RuntimeError
+    assert path.read_bytes() == b'share,batch\r\n'
+    assert os.listdir(tmp_path) == ['xfiles.csv']
+
+
+def test_hash_cache_reuses_hashes_until_a_file_changes(tmp_path):
+    paths = [str(tmp_path / f'list{n}.csv') for n in range(3)]
+    for n, path in enumerate(paths):
+        with open(path, 'w') as handle:
+            handle.write(f'list {n}\n')
+    cache = HashCache(str(tmp_path / 'hashes.db'))
+    hashes = hash_files(paths, cache, workers=2)
+    assert hashes == {path: calculate_md5(path) for path in paths}
+
+    # a cached hash is returned without reading the file
+    cache.store(cache.key(paths[0]), 'cached')
+    assert calculate_md5(paths[0], cache) == 'cached'
+    assert hash_files(paths, cache)[paths[0]] == 'cached'
+
+    # a file whose size or mtime changed is hashed again
+    with open(paths[0], 'w') as handle:
+        handle.write('changed list\n')
+    assert hash_files(paths, cache)[paths[0]] == calculate_md5(paths[0])
+
+    # and the cache persists between runs
+    cache.connection.commit()
+    assert HashCache(str(tmp_path / 'hashes.db')).lookup(
+        HashCache.key(paths[1])) == hashes[paths[1]]
+
+
+def test_prefetch_keeps_order_and_bounds_read_ahead():
+    started = []
+
+    def load(n):
+        started.append(n)
+        time.sleep(0.001 * (n % 3))
+        return n * n
+
+    results = []
+    for k, result in enumerate(prefetch(load, range(10), 2)):
+        # the item being yielded and at most two more have been started
+        assert len(started) <= k + 3
+        results.append(result)
+    assert results == [n * n for n in range(10)]
+    assert list(prefetch(load, range(3), 0)) == [0, 1, 4]
+
+    def fail(n):
+        if n == 2:
+            raise ValueError(n)
+        return n
+
+    loaded = prefetch(fail, range(5), 2)
+    assert [next(loaded), next(loaded)] == [0, 1]
+    with pytest.raises(ValueError):
+        next(loaded)
@@ -0,0 +1,104 @@
+from verifier import verify
+from verifier.accessions import Asset
+from verifier.accessions import Batch
+from verifier.restores import MatchIndex
+from verifier.utils import PathTrie
+
+
+def make_batch(*assets):
+    batch = Batch('test')
+    for asset in assets:
+        batch.count(asset)
+        batch.assets.append(asset)
+    return batch
+
+
+def quiet(message):
+    pass
+
+
+def test_path_trie_prefers_deepest_then_most_populated():
+    trie = PathTrie()
+    for path in ['/r/a/x/1.tif', '/r/a/x/2.tif', '/r/a/y/3.tif',
+                 '/r/b/4.tif']:
+        trie.add(path)
+    assert trie.score('/r/a/x/9.tif') == (4, 2)
+    assert trie.score('/r/a/z/9.tif') == (3, 3)
+    assert trie.best(['/r/b/9.tif', '/r/a/y/9.tif', '/r/a/x/9.tif']) == 2
+    # equal scores keep the first candidate
+    assert trie.best(['/q/1.tif', '/s/1.tif']) == 0
+    assert trie.branches() == {'/r/a': 3, '/r/b': 1}
+
+
+def test_path_trie_branches_count_files_at_divergence():
+    trie = PathTrie()
+    for path in ['/r/1.tif', '/r/a/2.tif', '/r/a/3.tif']:
+        trie.add(path)
+    assert trie.branches() == {'/r/a': 2, '/r': 1}
+
+
+def test_resolve_duplicates_picks_copy_near_single_matches():
+    index = MatchIndex([
+        ('a', 10, 'm1', 'one.tif', '/restored/batch/one.tif'),
+        ('c', 20, 'm2', 'two.tif', '/restored/retry/two.tif'),
+        ('b', 20, 'm2', 'two.tif', '/restored/batch/two.tif'),
+        ])
+    one = Asset('one.tif', 'list.csv', 0, bytes=10, md5='m1')
+    two = Asset('two.tif', 'list.csv', 1, bytes=20, md5='m2')
+    batch = make_batch(one, two)
+    assert verify.verify_batch(batch, index, [], log=quiet)
+    assert two.restored.id == 'b'
+    assert [c.id for c in two.extra_copies] == ['c']
+    assert batch.root == '/restored/batch'
+
+
+def test_match_assets_classifies_found_altered_and_missing():
+    index = MatchIndex([
+        ('p', 10, 'good', 'found.tif', '/r/found.tif'),
+        ('q', 10, 'bad', 'found.tif', '/r/copy/found.tif'),
+        ('x', 20, 'bad', 'altered.tif', '/r/altered.tif'),
+        ('n', 99, 'm', 'nohash.tif', '/r/nohash.tif'),
+        ])
+    found = Asset('found.tif', 'list.csv', 0, bytes=10, md5='good')
+    altered = Asset('altered.tif', 'list.csv', 1, bytes=20, md5='good')
+    missing = Asset('missing.tif', 'list.csv', 2, bytes=30, md5='good')
+    nohash = Asset('nohash.tif', 'list.csv', 3, bytes=99)
+    batch = make_batch(found, altered, missing, nohash)
+    duplicated = verify.match_assets(batch, batch.assets, index)
+    assert duplicated == []
+    assert [a.status for a in batch.assets] == \
+        ['Found', 'Altered', 'NotFound', 'Found']
+    assert found.restored.id == 'p'
+    assert nohash.restored.id == 'n'
+    assert [c.id for c in altered.duplicates] == ['x']
+    assert dict(batch.file_actions()) == {'p': 'transfer', 'q': 'altered',
+                                          'x': 'altered', 'n': 'transfer'}
+
+
+def test_streamed_batch_spools_the_same_actions(tmp_path):
+    index = MatchIndex([
+        ('p', 10, 'good', 'found.tif', '/r/b/found.tif'),
+        ('q', 10, 'bad', 'found.tif', '/r/c/found.tif'),
+        ('d1', 20, 'dup', 'dup.tif', '/r/b/dup.tif'),
+        ('d2', 20, 'dup', 'dup.tif', '/r/c/dup.tif'),
+        ])
+    path = tmp_path / 'test_2020_list.csv'
+    path.write_text('Filename,Size,MD5\n'
+                    'found.tif,10,good\n'
+                    'dup.tif,20,dup\n'
+                    'missing.tif,30,none\n'
+                    'Thumbs.db,40,thumbs\n')
+    results = {}
+    for spool_root in [None, str(tmp_path / 'package')]:
+        item = ('test', [str(path)], {}, ['Thumbs.db'], spool_root, True)
+        batch, complete = verify.run_batch(item, index, log=quiet)
+        results[spool_root is not None] = (
+            sorted(batch.file_actions()), sorted(batch.instance_actions())
+            )
+        batch.discard_action_spool()
+    assert results[True] == results[False]
+    file_actions, instance_actions = results[False]
+    assert file_actions == [('d1', 'transfer'), ('d2', 'duplicate'),
+                            ('p', 'transfer'), ('q', 'altered')]
+    assert [action for source, line, action in instance_actions] == \
+        ['perfect', 'perfect', 'missing', 'discard']
@@ -1,126 +1,417 @@
 #!/user/bin/env python3
 
+import argparse
+import cProfile
+import csv
+from concurrent.futures import ProcessPoolExecutor
+import fnmatch
+import json
+import multiprocessing
 import os
+import pstats
 import sys
+import time
 import yaml
 
-from . import accessions
-from .restores import Database
+from . import verify
+from .archiver import CheckpointStore
 from .archiver import Package
+from .metrics import METRICS
+from .restores import Database
+from .utils import HashCache
+from .utils import atomic_write
+from .utils import human_readable
+from .utils import prefetch
 
 
-def main():
+def record_hashes(hash_cache, hash_keys, batch):
+    """Save the md5 hashes of a batch's dirlists to the hash cache."""
+    if hash_cache is not None:
+        for dirlist in batch.dirlists:
+            hash_cache.store(hash_keys[dirlist.path], dirlist.md5)
 
-    # (1) load configuration
-    configfile = sys.argv[1]
-    with open(configfile) as handle:
-        config = yaml.safe_load(handle)
-    package_root = os.path.join(config['ROOTDIR'], config['OUTPUTDIR'])
-    source_root = os.path.join(config['ROOTDIR'], config['SOURCEDIR'])
-    database = Database(os.path.join(config['ROOTDIR'], config['DATABASE']))
-    package = Package(package_root)
-    exclude_patterns = config['EXCLUDES']
 
-    # (2) set up the set of all accession batches
+def load_config(path):
+    with open(path) as handle:
+        return yaml.safe_load(handle)
+
+
+def db_main(argv):
+    """Maintenance commands for the restored files database."""
+    parser = argparse.ArgumentParser(prog='verifier db')
+    commands = parser.add_subparsers(dest='command', required=True)
+    check = commands.add_parser(
+        'check', help='check query plans and indexes of the database'
+        )
+    check.add_argument('config', help='path to the YAML configuration file')
+    check.add_argument('--create', action='store_true',
+                       help='create any missing indexes')
+    args = parser.parse_args(argv)
+    config = load_config(args.config)
+    database_path = os.path.join(config['ROOTDIR'], config['DATABASE'])
+    database = Database(database_path, readonly=not args.create)
+    warnings = database.check_indexes(create=args.create)
+    for name, details in database.query_plans().items():
+        print(f"{name}:")
+        for detail in details:
+            print(f"    {detail}")
+    for warning in warnings:
+        print(f"WARNING: {warning}")
+    if warnings:
+        sys.exit(1)
+
+
+def record_actions(database, accessions, batch):
+    """
+    Write the actions classified for a batch to the files table and, where
+    there is an accessions database with an instances table, to instances.
+    """
+    with database.connection:
+        database.record_file_actions(batch.file_actions())
+    if accessions is not None:
+        with accessions.connection:
+            accessions.record_instance_actions(batch.instance_actions())
+    batch.discard_action_spool()
+
+
+def find_batches(source_root):
+    """Group the dirlists in source_root by the batch name they start with."""
     batches = {}
     for file in os.listdir(source_root):
         try:
             batchname, date, extra = file.split('_', 2)
-            dirlist = accessions.DirList(os.path.join(source_root, file))
-            batches.setdefault(batchname, []).append(dirlist)
+            batches.setdefault(batchname, []).append(
+                os.path.join(source_root, file)
+                )
         except ValueError:
             sys.stdout.write(f"Could not parse file: {file}\n")
             sys.exit(1)
+    return batches
 
-    # (3) Read accessions
-    for batchname in sorted(batches.keys()):
-        print(f'\n{batchname.upper()}\n{"=" * len(batchname)}')
-        batch = accessions.Batch(batchname, *batches[batchname])
-        print(f"  Creating {batch.identifier}...")
-        print(f"  Source Files: {len(batch.dirlists)}")
-        for n, dirlist in enumerate(batch.dirlists, 1):
-            print(f"    ({n}) {dirlist.filename}: {len(dirlist.lines)} lines")
-        print(f"  Total Assets: {len(batch.assets)}")
-
-        # c. check for in-batch duplicate files
-        print(f"  Has duplicate files: {batch.has_duplicates()}")
-
-        # (4) Process assets
-        print(f"  Processing batch assets...")
-        assets_with_duplicates = []
-        restores = []
-        for n, asset in enumerate(batch.assets, 1):
-            # a. skip excluded filenames
-            if asset.filename in exclude_patterns:
-                #print(  f"Excluding {asset.filename}!")
-                asset.status = 'Deaccession'
-                continue
 
-            # b. skip invisible files
-            if asset.filename.startswith('.'):
-                #print(  f"Skipping invisible file {asset.filename}!")
-                asset.status = 'Deaccession'
-                continue
+def select_batches(batches, names=None, pattern=None):
+    """
+    Return the batches whose names are among names or match the glob
+    pattern; all of them if neither is given.
+    """
+    if not names and pattern is None:
+        return batches
+    return {batchname: paths for batchname, paths in batches.items()
+            if (names and batchname in names) or
+               (pattern is not None and fnmatch.fnmatchcase(batchname,
+                                                            pattern))}
+
 
-            # d. look for restored copies
-            if asset.md5 is None and asset.bytes is None:
-                matches = database.match_filename(asset)
-            elif asset.md5 is None and asset.bytes is not None:
-                matches = database.match_filename_bytes(asset)
-            
-            # if previous has failed, try simple filename match
-            if not matches:
-                matches = database.match_filename_bytes_md5(asset)
-
-            if matches:
-                asset.status = 'Found'
-                if len(matches) == 1:
-                    asset.restored = matches[0]
-                    restores.append(matches[0].path)
-                else:
-                    asset.duplicates = matches
-                    assets_with_duplicates.append(asset)
+def verify_all(work, jobs, database_path, use_index, checkpoints=None,
+               prefetch_batches=0):
+    """
+    Verify each work item, serially or in a pool of worker processes, and
+    yield (batch, complete) in the order of the work items.  Items with an
+    up-to-date checkpoint are loaded from it, one at a time as they come
+    up, instead, and the results of the others are checkpointed as they
+    come back.  When verifying serially, up to prefetch_batches of the
+    following batches are loaded in background threads while each one is
+    matched.
+    """
+    if checkpoints is not None:
+        with METRICS.stage('checkpoint'):
+            current = [checkpoints.is_current(item) for item in work]
+    else:
+        current = [False for item in work]
+    pending = [item for item, saved in zip(work, current) if not saved]
+    databases = []
+
+    def local_database():
+        if not databases:
+            databases.append(verify.open_database(database_path, use_index,
+                                                  readonly=True))
+        return databases[0]
+
+    def run_serially(item, loaded=None):
+        batch, messages = loaded if loaded is not None else (None, [])
+        for message in messages:
+            print(message)
+        def log(message):
+            print(message)
+            messages.append(message)
+        batch, complete = verify.run_batch(item, local_database(), log=log,
+                                           batch=batch)
+        return batch, complete, messages, None
+
+    if jobs > 1 and pending:
+        context = None
+        if use_index and 'fork' in multiprocessing.get_all_start_methods():
+            # build the index once here; forked workers share its pages
+            # instead of each reading the whole files table
+            verify.worker_database = verify.open_database(database_path,
+                                                          use_index)
+            context = multiprocessing.get_context('fork')
+        pool = ProcessPoolExecutor(
+            max_workers=jobs,
+            mp_context=context,
+            initializer=verify.init_worker,
+            initargs=(database_path, use_index)
+            )
+        # results come back in submission order, so the package is
+        # assembled exactly as in a serial run
+        results = pool.map(verify.run_batch_in_worker, pending)
+    else:
+        pool = None
+
+        def load(item):
+            messages = []
+            return verify.load_item(item, log=messages.append), messages
+
+        results = map(run_serially, pending,
+                      prefetch(load, pending, prefetch_batches))
+    try:
+        for item, saved in zip(work, current):
+            result = None
+            if saved:
+                with METRICS.stage('checkpoint', items=1):
+                    result = checkpoints.load(item)
+            if result is not None:
+                batch, complete, messages = result
+                for message in messages:
+                    print(message)
+                yield batch, complete
+                continue
+            if saved:
+                # the checkpoint went stale or could not be read after it
+                # was checked, so the batch is verified here instead
+                batch, complete, messages, worker_metrics = run_serially(item)
             else:
-                asset.status = 'NotFound'
-            
-        # if nothing in batch was found, abort here
-        if all([asset.status == 'NotFound' for asset in batch.assets]):
-            print(f'  No Assets in this batch were found. Skipping...')
-            continue
-            
-        # Add "best match" duplicates to transfer batch
-        common_path = os.path.commonpath(restores)
-        print(f"  Common Path: {common_path}")
-        for asset in assets_with_duplicates:
-            for candidate in asset.duplicates:
-                if candidate.path.startswith(common_path):
-                    asset.restored = candidate
-                    asset.duplicates.remove(candidate)
-                    asset.extra_copies.extend(asset.duplicates)
-                    break
-                else:
-                    asset.extra_copies.append(candidate)
-            # if a relpath match is not found, use first duplicate
-            if not asset.restored:
-                asset.restored = asset.extra_copies.pop(0)
-            print(asset.restored.path)
-            print([f.path for f in asset.extra_copies])
-
-        # Update batch status to reflect state of assets
-        if all([a.status == 'Found' for a in batch.assets]):
-            batch.status = 'Complete'
-            package.add(batch)
-            print(f"  Asset Root: {batch.asset_root}")
+                batch, complete, messages, worker_metrics = next(results)
+            if pool is not None and worker_metrics is not None:
+                for message in messages:
+                    print(message)
+                METRICS.merge(worker_metrics)
+            if checkpoints is not None:
+                with METRICS.stage('checkpoint'):
+                    checkpoints.save(item, batch, complete, messages)
+            yield batch, complete
+    finally:
+        if pool is not None:
+            pool.shutdown()
+            verify.worker_database = None
+
+
+def xfiles_main(argv):
+    """
+    Report the restored files not matched by any accession, grouped by the
+    share and batch of the restored file list they came from.  Excluded
+    and invisible files are discards, not x-files, and are left out.
+    """
+    parser = argparse.ArgumentParser(prog='verifier xfiles')
+    parser.add_argument('config', help='path to the YAML configuration file')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of batches to verify in parallel')
+    parser.add_argument('--no-checkpoints', action='store_true',
+                        help='verify every batch, ignoring and not saving '
+                             'checkpoints of earlier runs')
+    args = parser.parse_args(argv)
+    config = load_config(args.config)
+    package_root = os.path.join(config['ROOTDIR'], config['OUTPUTDIR'])
+    source_root = os.path.join(config['ROOTDIR'], config['SOURCEDIR'])
+    database_path = os.path.join(config['ROOTDIR'], config['DATABASE'])
+    use_index = bool(config.get('MATCH_INDEX'))
+    exclude_patterns = config['EXCLUDES']
+    batches = find_batches(source_root)
+    work = [(batchname, batches[batchname], {}, exclude_patterns, None,
+             False) for batchname in sorted(batches.keys())]
+    # the work items are those of a verifier run, so batches it left
+    # checkpoints for are not verified again
+    if args.no_checkpoints:
+        checkpoints = None
+    else:
+        checkpoints = CheckpointStore(package_root, database_path)
+
+    # record every restored file matched by any asset, complete or not
+    database = Database(database_path, readonly=True)
+    for batch, complete in verify_all(work, args.jobs, database_path,
+                                      use_index, checkpoints):
+        database.add_matched_files(id for id, action in batch.file_actions())
+
+    if not os.path.exists(package_root):
+        os.makedirs(package_root)
+    path = os.path.join(package_root, 'xfiles.csv')
+    print(f"\nWriting x-files to {path}...")
+    groups = {}
+    with atomic_write(path, newline='') as handle:
+        writer = csv.writer(handle)
+        writer.writerow(['share', 'batch', 'md5', 'bytes', 'path'])
+        for row in database.unmatched_files(exclude_patterns):
+            writer.writerow(row)
+            share, batch, md5, bytes, filepath = row
+            count, total = groups.get((share, batch), (0, 0))
+            groups[(share, batch)] = (count + 1, total + (bytes or 0))
+    for (share, batch), (count, total) in sorted(
+            groups.items(), key=lambda g: (str(g[0][0]), str(g[0][1]))):
+        print(f"  {share} {batch}: {count} files, {human_readable(total)}")
+    print(f"  Total: {sum(c for c, t in groups.values())} x-files")
+
+
+def main():
+    if sys.argv[1:2] == ['db']:
+        return db_main(sys.argv[2:])
+    elif sys.argv[1:2] == ['xfiles']:
+        return xfiles_main(sys.argv[2:])
+
+    # (1) load configuration
+    parser = argparse.ArgumentParser(prog='verifier')
+    parser.add_argument('config', help='path to the YAML configuration file')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of batches to verify in parallel')
+    parser.add_argument('--stream', action='store_true',
+                        help='stream dirlists instead of loading them whole')
+    parser.add_argument('--prefetch', type=int, default=2, metavar='N',
+                        help='batches to load ahead in background threads '
+                             'when verifying serially (0 to disable; always '
+                             '0 with --profile)')
+    parser.add_argument('--batch', action='append', metavar='NAME',
+                        help='only verify the named batch (repeatable); the '
+                             'package then lists only the selected batches')
+    parser.add_argument('--match', metavar='GLOB',
+                        help='only verify batches whose names match GLOB')
+    parser.add_argument('--no-checkpoints', action='store_true',
+                        help='verify every batch, ignoring and not saving '
+                             'checkpoints of earlier runs')
+    parser.add_argument('--actions', action='store_true',
+                        help='record the classification of every restored '
+                             'file and accessioned instance in the databases')
+    parser.add_argument('--profile', action='store_true',
+                        help='profile verification in this process and '
+                             'save the profile to the package directory; '
+                             'batches are then loaded without --prefetch, '
+                             'whose threads the profiler does not trace')
+    args = parser.parse_args()
+    if args.profile:
+        # cProfile only traces the main thread, which would leave out the
+        # parsing done by the prefetch threads
+        args.prefetch = 0
+    start = time.perf_counter()
+    config = load_config(args.config)
+    package_root = os.path.join(config['ROOTDIR'], config['OUTPUTDIR'])
+    source_root = os.path.join(config['ROOTDIR'], config['SOURCEDIR'])
+    database_path = os.path.join(config['ROOTDIR'], config['DATABASE'])
+    use_index = bool(config.get('MATCH_INDEX'))
+    if config.get('HASH_CACHE'):
+        hash_cache = HashCache(
+            os.path.join(config['ROOTDIR'], config['HASH_CACHE'])
+            )
+    else:
+        hash_cache = None
+    package = Package(package_root)
+    exclude_patterns = config['EXCLUDES']
+    if args.actions:
+        # opened before verification starts, so the database is already in
+        # WAL mode when the read-only connections are made
+        actions_database = Database(database_path)
+        if config.get('ACCESSIONS_DATABASE'):
+            accessions = Database(os.path.join(
+                config['ROOTDIR'], config['ACCESSIONS_DATABASE']
+                ))
+        else:
+            accessions = actions_database
+        if not accessions.has_table('instances'):
+            print("No instances table found; instance actions not recorded")
+            accessions = None
+        else:
+            accessions.create_instance_indexes()
+        # files left without an action by every batch are classified at
+        # the end; with only some batches verified, the files matched by
+        # the others are unknown, so they keep the actions they have
+        classify_unmatched = not (args.batch or args.match)
+        if classify_unmatched:
+            with actions_database.connection:
+                actions_database.clear_file_actions()
+        else:
+            print("WARNING: batches selected; actions are only recorded for "
+                  "their files, and unmatched files are not classified")
+
+    # (2) set up the set of all accession batches
+    with METRICS.stage('list'):
+        batches = select_batches(find_batches(source_root),
+                                 args.batch, args.match)
+    if not batches:
+        sys.stdout.write(f"No batches selected in {source_root}\n")
+        sys.exit(1)
+    METRICS.add('list', items=sum(len(paths) for paths in batches.values()))
+
+    # look up dirlist hashes from earlier runs; the rest are hashed as the
+    # dirlists are read, which is timed as part of parsing, and recorded
+    # once they come back
+    hash_keys = {}
+    hashes = {}
+    if hash_cache is not None:
+        with METRICS.stage('hash-cache'):
+            for paths in batches.values():
+                for path in paths:
+                    hash_keys[path] = hash_cache.key(path)
+                    hashes[path] = hash_cache.lookup(hash_keys[path])
+        METRICS.add('hash-cache',
+                    items=sum(md5 is not None for md5 in hashes.values()))
+
+    # streamed batches are spooled into the package as they are verified,
+    # so they are not checkpointed
+    if args.stream or args.no_checkpoints:
+        checkpoints = None
+    else:
+        checkpoints = CheckpointStore(package.root, database_path)
+
+    # (3) Read and verify accessions, one batch at a time or in parallel
+    work = [(batchname, batches[batchname],
+             {path: hashes.get(path) for path in batches[batchname]},
+             exclude_patterns, package.root if args.stream else None,
+             args.actions)
+            for batchname in sorted(batches.keys())]
+    profiler = cProfile.Profile() if args.profile else None
+    if profiler is not None:
+        profiler.enable()
+    with METRICS.stage('verify', items=len(work)):
+        for batch, complete in verify_all(work, args.jobs, database_path,
+                                          use_index, checkpoints,
+                                          args.prefetch):
+            if hash_cache is not None:
+                with METRICS.stage('hash-cache'):
+                    record_hashes(hash_cache, hash_keys, batch)
+            if args.actions:
+                with METRICS.stage('actions', items=batch.num_assets):
+                    record_actions(actions_database, accessions, batch)
+            if complete:
+                package.add(batch)
+    if profiler is not None:
+        profiler.disable()
+
+    # (4) Classify the restored files left unmatched by every batch
+    if args.actions and classify_unmatched:
+        print(f"Recording actions for unmatched files...")
+        with METRICS.stage('actions'):
+            with actions_database.connection:
+                actions_database.record_unmatched_actions(exclude_patterns)
 
     # (5) Write out upload package
     print(f"Writing {len(package.batches)} batches to upload package...")
     for n, batch in enumerate(package.batches, 1):
         print(f"  ({n}) {batch.identifier} is complete and ready to load!")
-    print(f"Writing package summary file...")
-    with open(os.path.join(package.root, 'summary.json'), 'w') as handle:
-        handle.write(package.write_summary())
-    print(f"Writing package batch dirs...")
-    package.serialize_batches()
+    with METRICS.stage('serialize', items=len(package.batches)):
+        print(f"Writing package summary file...")
+        with atomic_write(os.path.join(package.root, 'summary.json')) as handle:
+            handle.write(package.write_summary())
+        print(f"Writing package batch dirs...")
+        package.serialize_batches()
+
+    # (6) Write out metrics and profile
+    metrics = METRICS.as_dict()
+    metrics['jobs'] = args.jobs
+    metrics['wall_seconds'] = round(time.perf_counter() - start, 6)
+    with atomic_write(os.path.join(package.root, 'metrics.json')) as handle:
+        handle.write(json.dumps(metrics, indent=4, sort_keys=True))
+    if profiler is not None:
+        path = os.path.join(package.root, 'profile.pstats')
+        profiler.dump_stats(path)
+        print(f"Saved profile to {path}; slowest calls:")
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(20)
 
 
 if __name__ == "__main__":
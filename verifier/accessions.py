@@ -1,27 +1,43 @@
+from collections import Counter
+from contextlib import contextmanager
 import csv
 from datetime import datetime
+from functools import cached_property
+from functools import lru_cache
+import hashlib
+from itertools import chain
+import mmap
 import os
 import re
 import sys
 
-from .utils import calculate_md5
+from .utils import LineReader
+from .utils import PathTrie
+from .utils import read_text
 from .utils import human_readable
 
 
 class Asset():
     """
-    Class representing a single asset under preservation.
+    Class representing a single asset under preservation.  Batches can hold
+    millions of these, so attributes live in slots and the duplicate lists
+    start out as a shared empty tuple, to be replaced with a list only for
+    the few assets that have more than one restored copy.
     """
 
+    __slots__ = ('filename', 'bytes', 'timestamp', 'md5', 'restored',
+                 'duplicates', 'extra_copies', 'sourcefile', 'sourceline',
+                 'status')
+
     def __init__(self, filename, sourcefile, sourceline,
                  bytes=None, timestamp=None, md5=None):
         self.filename = filename
         self.bytes = bytes
         self.timestamp = timestamp
         self.md5 = md5
-        self.restored = []
-        self.duplicates = []
-        self.extra_copies = []
+        self.restored = None
+        self.duplicates = ()
+        self.extra_copies = ()
         self.sourcefile = sourcefile
         self.sourceline = sourceline
         self.status = 'Not checked'
@@ -30,49 +46,168 @@ class Asset():
     def signature(self):
         return (self.filename, self.md5, self.bytes)
 
+    def is_altered(self, copy):
+        """True if a restored copy of this asset differs from it in md5."""
+        return self.md5 is not None and copy.md5 != self.md5
+
+    def file_actions(self):
+        """
+        Yield (file id, action) for each restored copy matched to this
+        asset: the one transferred, its extra copies and the altered ones.
+        """
+        if self.restored is not None:
+            yield self.restored.id, 'transfer'
+        for copy in self.extra_copies:
+            yield copy.id, 'duplicate'
+        for copy in self.duplicates:
+            if self.is_altered(copy):
+                yield copy.id, 'altered'
+
+    @property
+    def instance_action(self):
+        return INSTANCE_ACTIONS[self.status]
+
+
+# Action recorded for an accessioned instance, by the status of its asset
+INSTANCE_ACTIONS = {
+    'Found':       'perfect',
+    'Deaccession': 'discard',
+    'Altered':     'altered',
+    'NotFound':    'missing'
+    }
+
 
 class Batch():
     """
-    Class representing a set of assets having been accessioned.
+    Class representing a set of assets having been accessioned.  Counts,
+    byte totals, hash coverage, duplicate signatures, status counts and the
+    common path of restored copies are accumulated as assets are added and
+    classified, so none of the batch statistics needs a pass over the
+    assets.  A streamed batch does not load its assets up front; they are
+    read lazily from the dirlists with iter_assets, and only those needing
+    follow-up are kept.  The actions for the batch's restored files and
+    instances are worked out from its assets when asked for, along with
+    those spooled for the assets a streamed batch did not keep.
     """
 
-    def __init__(self, identifier, *dirlists):
+    def __init__(self, identifier, *dirlists, stream=False):
         self.identifier = identifier
         self.dirlists = [d for d in dirlists]
         self.assets = []
         self.status = None
-        for dirlist in self.dirlists:
-            self.load_assets(dirlist)
+        self.streamed = stream
+        self.num_assets = 0
+        self.total_bytes = 0
+        self.unhashed = 0
+        self.statuses = Counter()
+        # signatures are not kept for streamed batches, whose point is to
+        # avoid holding every asset's details in memory
+        self.signatures = None if stream else set()
+        self.duplicate_signatures = 0
+        self.root = None
+        self.restore_paths = PathTrie()
+        self.spool = None
+        self.action_spool = None
+        if not stream:
+            for dirlist in self.dirlists:
+                self.load_assets(dirlist)
 
     @property
     def bytes(self):
-        return sum(
-            [asset.bytes for asset in self.assets if asset.bytes is not None]
-            )
+        return self.total_bytes
 
     @property
     def has_hashes(self):
-        return all(
-            [asset.md5 is not None for asset in self.assets]
-            )
+        return self.unhashed == 0
+
+    def count(self, asset):
+        """Add an asset to the batch's running totals."""
+        self.num_assets += 1
+        if asset.bytes is not None:
+            self.total_bytes += asset.bytes
+        if asset.md5 is None:
+            self.unhashed += 1
+        self.statuses[asset.status] += 1
+        if self.signatures is not None:
+            signature = asset.signature
+            if signature in self.signatures:
+                self.duplicate_signatures += 1
+            else:
+                self.signatures.add(signature)
+
+    def classify(self, asset, status):
+        """Set the status of one of the batch's assets."""
+        self.statuses[asset.status] -= 1
+        self.statuses[status] += 1
+        asset.status = status
+
+    def restore(self, asset, restored):
+        """
+        Set the restored copy of an asset, updating the common path and
+        the index of restored paths.
+        """
+        asset.restored = restored
+        self.restore_paths.add(restored.path)
+        if self.root is None:
+            self.root = restored.path
+        else:
+            self.root = os.path.commonpath([self.root, restored.path])
+
+    def file_actions(self):
+        """Yield (file id, action) for the restored files of the batch."""
+        for row in self.spooled_actions('file'):
+            yield tuple(row)
+        for asset in self.assets:
+            yield from asset.file_actions()
+
+    def instance_actions(self):
+        """Yield (sourcefile, sourceline, action) for each asset."""
+        for sourcefile, sourceline, action in self.spooled_actions('instance'):
+            yield sourcefile, int(sourceline), action
+        for asset in self.assets:
+            yield asset.sourcefile, asset.sourceline, asset.instance_action
+
+    def spooled_actions(self, kind):
+        if self.action_spool is not None:
+            with open(self.action_spool, newline='') as handle:
+                for row in csv.reader(handle):
+                    if row[0] == kind:
+                        yield row[1:]
+
+    def discard_action_spool(self):
+        if self.action_spool is not None:
+            os.remove(self.action_spool)
+            self.action_spool = None
+
+    def all_have_status(self, status):
+        return self.statuses[status] == self.num_assets
 
     def load_assets(self, dirlist):
-        self.assets.extend([asset for asset in dirlist.assets])
+        for asset in dirlist.assets:
+            self.count(asset)
+            self.assets.append(asset)
+
+    def iter_assets(self):
+        """Yield the assets of every dirlist, counting them on the way."""
+        for dirlist in self.dirlists:
+            for asset in dirlist.iter_assets():
+                self.count(asset)
+                yield asset
 
     def summary_dict(self):
         return {'identifier': self.identifier,
                 'dirlists': {d.md5: d.filename for d in self.dirlists},
-                'num_assets': len(self.assets),
+                'num_assets': self.num_assets,
                 'bytes': self.bytes,
                 'human_readable': human_readable(self.bytes),
                 'status': self.status
                 }
     @property
     def asset_root(self):
-        return os.path.commonpath([a.restored.path for a in self.assets])
+        return self.root
 
     def has_duplicates(self):
-        return len(self.assets) < len(set([a.signature for a in self.assets]))
+        return self.duplicate_signatures > 0
 
 
 class DirList():
@@ -81,134 +216,396 @@ class DirList():
     making up all or part of a batch.
     """
 
-    def __init__(self, path):
+    def __init__(self, path, md5=None, stream=False):
         self.filename = os.path.basename(path)
         self.path = path
         self.bytes = int(os.path.getsize(path))
-        self.md5 = calculate_md5(path)
         self.dirlines = 0
         self.extralines = 0
-        self.lines = self.read()
+        self.reader = None
+        self.mapped = None
+        self.released_lines = None
+        if stream:
+            # the md5, if not known already, is set once the file is read
+            self.md5, self.lines = md5, None
+            self.reader = LineReader(self.path, md5=md5)
+        else:
+            if self.bytes >= MMAP_THRESHOLD:
+                self.mapped = MappedInventory.scan(path, md5)
+            if self.mapped is not None:
+                self.md5, self.lines = self.mapped.md5, None
+            else:
+                self.md5, self.lines = self.read(md5)
+
+    def read(self, md5=None):
+        md5, handle, encoding = read_text(self.path, md5=md5)
+        if handle is None:
+            print(f'Could not read directory listing file {self.path}')
+            sys.exit(1)
+        return md5, [line.strip() for line in handle]
+
+    @cached_property
+    def parser(self):
+        """The parser for this dirlist's format, sniffed from its first line."""
+        return sniff_parser(self.lines[0])
 
-    def read(self):
-        for encoding in ['utf8', 'iso-8859-1', 'macroman']:
+    @cached_property
+    def assets(self):
+        if self.mapped is not None:
             try:
-                with open(self.path, encoding=encoding) as handle:
-                    return [line.strip() for line in handle.readlines()]
-            except ValueError:
-                continue
-        print(f'Could not read directory listing file {self.path}')
-        sys.exit(1)
+                return list(self.mapped.iter_assets(self.filename))
+            except IrregularInventory:
+                # fall back to decoding the whole file
+                self.md5, self.lines = self.read(self.md5)
+                self.mapped = None
+        return self.parser.parse(self)
 
     @property
-    def assets(self):
-        results = []
-        # Examine the dirlist layout and set up iteration
-        # Handle space-delimited dirlists
-        ptrn = r'^(\d{2}/\d{2}/\d{4}\s+\d{2}:\d{2}\s[AP]M)\s+([0-9,]+)\s(.+?)$'
-        if self.lines[0].startswith('Volume in drive'):
-            for n, line in enumerate(self.lines):
-                # check if the line describes an asset
-                match = re.match(ptrn, line)
-                if not match:
-                    continue
-                else:
-                    timestamp = datetime.strptime(match.group(1),
-                                                 '%m/%d/%Y %I:%M %p'
-                                                 )
-                    bytes = int(''.join(
-                        [c for c in match.group(2) if c.isdigit()])
-                        )
-                    filename = match.group(3)
-                    results.append(
-                        Asset(filename=filename, bytes=bytes,
-                              timestamp=timestamp, sourcefile=self.filename,
-                              sourceline=n)
-                        )
-            return results
-
-        # Handle semi-colon separted dirlists
-        elif ';' in self.lines[0]:
-            for n, line in enumerate(self.lines):
-                cols = line.split(';')
-                if cols[2] == 'Directory':
+    def line_count(self):
+        if self.released_lines is not None:
+            return self.released_lines
+        elif self.reader is not None:
+            return self.reader.lines
+        elif self.mapped is not None:
+            return self.mapped.line_count
+        return len(self.lines)
+
+    def release(self):
+        """
+        Drop the lines and parsed assets of a dirlist once its batch has
+        been verified; the batch keeps the assets it needs.
+        """
+        self.released_lines = self.line_count
+        self.lines = None
+        self.__dict__.pop('assets', None)
+        self.__dict__.pop('parser', None)
+
+    def iter_assets(self):
+        """
+        Yield assets straight from the file without keeping its lines,
+        for dirlists opened with stream=True.
+        """
+        try:
+            lines = iter(self.reader)
+            head = next(lines, None)
+        except ValueError:
+            print(f'Could not read directory listing file {self.path}')
+            sys.exit(1)
+        if head is not None:
+            parser = sniff_parser(head)
+            yield from parser.iter_assets(chain([head], lines), self.filename)
+        self.md5 = self.reader.md5
+
+
+# Delimited inventories at least this large are parsed from a memory map
+MMAP_THRESHOLD = 32 * 1024 * 1024
+MMAP_CHUNK_SIZE = 16 * 1024 * 1024
+
+
+class IrregularInventory(Exception):
+    """Raised when a mapped inventory needs the full text parser after all."""
+
+
+class MappedInventory():
+    """
+    Byte-level reader for large CSV and TSV inventories.  The file is
+    memory-mapped and split into lines and fields as raw bytes, and only
+    the filename, size, timestamp and md5 fields are decoded.
+
+    To give exactly the same assets as DelimitedParser, it is only used on
+    files for which decoding, stripping and csv parsing cannot differ from
+    byte-level splitting: pure ASCII (so all of the fallback encodings
+    agree), no quote characters, carriage returns, NULs or separator
+    control characters.  Rows the text parser would fail on raise
+    IrregularInventory, so the caller can use it instead and fail alike.
+    """
+
+    unsuitable = re.compile(rb'[^\x01-\x0c\x0e-\x1b\x20\x21\x23-\x7f]')
+    nondigits = re.compile(rb'\D')
+
+    def __init__(self, path, head, line_count, md5):
+        self.path = path
+        self.head = head
+        self.line_count = line_count
+        self.md5 = md5
+
+    @classmethod
+    def scan(cls, path, md5=None):
+        """
+        Return a reader for path if it is a delimited inventory this reader
+        can parse, otherwise None.  The suitability check, line count and
+        md5 (unless known already) are all done in one pass over the map.
+        """
+        if os.path.getsize(path) == 0:
+            return None
+        with open(path, 'rb') as f, \
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            head = mm.readline().strip()
+            if not head or cls.unsuitable.search(head) is not None:
+                return None
+            head = head.decode('ascii')
+            if sniff_parser(head) is not DEFAULT_PARSER:
+                return None
+            hash = hashlib.md5() if md5 is None else None
+            line_count = 0
+            for start in range(0, len(mm), MMAP_CHUNK_SIZE):
+                chunk = mm[start:start + MMAP_CHUNK_SIZE]
+                if cls.unsuitable.search(chunk) is not None:
+                    return None
+                line_count += chunk.count(b'\n')
+                if hash is not None:
+                    hash.update(chunk)
+            if mm[-1:] != b'\n':
+                line_count += 1
+        if hash is not None:
+            md5 = hash.hexdigest()
+        return cls(path, head, line_count, md5)
+
+    @contextmanager
+    def open(self):
+        with open(self.path, 'rb') as f, \
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            yield mm
+
+    def iter_assets(self, sourcefile):
+        delimiter = '\t' if '\t' in self.head else ','
+        fieldnames = self.head.split(delimiter)
+        keys = DEFAULT_PARSER.operative_keys(fieldnames)
+        # later duplicate column names win, as in csv.DictReader
+        position = {name: i for i, name in enumerate(fieldnames)}
+        columns = {attribute: position[key] for attribute, key in keys.items()
+                   if key in position}
+        prange = 'File Name' in position
+        filename_col = position.get('File Name')
+        type_col = position.get('Type')
+        width = len(fieldnames)
+        separator = delimiter.encode('ascii')
+        filename_i = columns.get('filename')
+        timestamp_i = columns.get('timestamp')
+        md5_i = columns.get('md5')
+        bytes_col = columns.get('bytes')
+        nondigits = self.nondigits
+
+        with self.open() as mm:
+            mm.readline()
+            n = 0
+            for line in iter(mm.readline, b''):
+                line = line.strip()
+                if not line:
                     continue
-                else:
-                    filename = os.path.basename(cols[0].rsplit('\\')[-1])
-                    timestamp = datetime.strptime(cols[1],
-                                                  '%m/%d/%Y %I:%M:%S %p'
-                                                  )
-                    bytes = round(float(cols[2].replace(',', '')) * 1024)
-                    results.append(
-                        Asset(filename=filename, bytes=bytes,
-                              timestamp=timestamp, sourcefile=self.filename,
-                              sourceline=n)
-                        )
-            return results
-
-        # Handle CSV and TSV files
-        else:
-            delimiter = '\t' if '\t' in self.lines[0] else ','
-            possible_keys = {
-                'filename': ['Filename', 'File Name', 'FILENAME', 'Key',
-                             '"Filename"', '"Key"'],
-                'bytes': ['Size', 'SIZE', 'File Size', 'Bytes', 'BYTES',
-                          '"Size"'],
-                'timestamp': ['Mod Date', 'Moddate', 'MODDATE', '"Mod Date"'],
-                'md5': ['MD5', 'Other', 'Data', '"Other"', '"Data"', 'md5']
-                }
-            columns = self.lines[0].split(delimiter)
-            operative_keys = {}
-            for attribute, keys in possible_keys.items():
-                for key in keys:
-                    if key in columns:
-                        operative_keys[attribute] = key.replace('"','')
-                        break
-            reader = csv.DictReader(self.lines,
-                                    quotechar='"',
-                                    delimiter=delimiter
-                                    )
-            for n, row in enumerate(reader):
+                cols = line.split(separator)
+                # missing trailing fields are None, as with csv.DictReader
+                if len(cols) < width:
+                    cols.extend([None] * (width - len(cols)))
                 # Skip extra rows in Prange-style "CSV" files
-                if 'File Name' in row and any([
-                    (row.get('Type') == 'Directory'),
-                    (row.get('File Name').startswith('Extension')),
-                    (row.get('File Name').startswith('Total file size')),
-                    (row.get('File Name') == '')
-                    ]):
-                    continue
+                if prange:
+                    name = cols[filename_col]
+                    if name is None:
+                        raise IrregularInventory(self.path)
+                    if ((type_col is not None and
+                            cols[type_col] == b'Directory') or
+                            name.startswith(b'Extension') or
+                            name.startswith(b'Total file size') or
+                            name == b''):
+                        n += 1
+                        continue
+                filename = field(cols, filename_i)
+                timestamp = field(cols, timestamp_i)
+                md5 = field(cols, md5_i)
+                if bytes_col is not None:
+                    raw = cols[bytes_col]
+                    if raw is None:
+                        raise IrregularInventory(self.path)
+                    if not raw.isdigit():
+                        raw = nondigits.sub(b'', raw)
+                    bytes = int(raw) if raw != b'' else None
                 else:
-                    filename_key = operative_keys.get('filename')
-                    if filename_key is not None:
-                        filename = row[filename_key]
-                    else:
-                        filename = None
-
-                    bytes_key = operative_keys.get('bytes')
-                    if bytes_key is not None:
-                        raw = row[bytes_key]
-                        digits = ''.join([c for c in raw if c.isdigit()])
-                        if digits is not '':
-                            bytes = int(digits)
-                        else:
-                            bytes = None
+                    bytes = None
+                yield Asset(filename=filename, bytes=bytes,
+                            timestamp=timestamp, md5=md5,
+                            sourcefile=sourcefile, sourceline=n)
+                n += 1
+
+
+def field(cols, i):
+    """Decode column i of a split row, or None if it is absent."""
+    if i is None or cols[i] is None:
+        return None
+    return cols[i].decode('ascii')
+
+
+# Registry of dirlist format parsers, consulted in order by sniff_parser;
+# files matching none of them are read by DelimitedParser
+PARSERS = []
+
+
+def register_parser(parser):
+    """Class decorator adding a dirlist format parser to the registry."""
+    PARSERS.append(parser())
+    return parser
+
+
+def sniff_parser(head):
+    """Return the parser for a dirlist whose first line is head."""
+    for parser in PARSERS:
+        if parser.sniff(head):
+            return parser
+    return DEFAULT_PARSER
+
+
+@lru_cache(maxsize=65536)
+def parse_timestamp(value, format):
+    """
+    Parse a timestamp, memoized since inventories repeat the same minute
+    thousands of times.
+    """
+    return datetime.strptime(value, format)
+
+
+class DirListParser():
+    """
+    Base class for dirlist format parsers.  Subclasses decide from the
+    first line of a file whether they can read it, and turn the lines of
+    a DirList into a list of Assets.
+    """
+
+    def sniff(self, head):
+        return False
+
+    def parse(self, dirlist):
+        return list(self.iter_assets(dirlist.lines, dirlist.filename))
+
+    def iter_assets(self, lines, sourcefile):
+        """Yield an Asset for each entry in an iterable of lines."""
+        raise NotImplementedError
+
+
+@register_parser
+class WindowsDirParser(DirListParser):
+    """Space-delimited listings produced by the Windows dir command."""
+
+    pattern = re.compile(
+        r'^(\d{2}/\d{2}/\d{4}\s+\d{2}:\d{2}\s[AP]M)\s+([0-9,]+)\s(.+?)$'
+        )
+
+    def sniff(self, head):
+        return head.startswith('Volume in drive')
+
+    def iter_assets(self, lines, sourcefile):
+        for n, line in enumerate(lines):
+            # check if the line describes an asset
+            match = self.pattern.match(line)
+            if not match:
+                continue
+            else:
+                timestamp = parse_timestamp(match.group(1),
+                                            '%m/%d/%Y %I:%M %p'
+                                            )
+                bytes = int(match.group(2).replace(',', ''))
+                filename = match.group(3)
+                yield Asset(filename=filename, bytes=bytes,
+                            timestamp=timestamp, sourcefile=sourcefile,
+                            sourceline=n)
+
+
+@register_parser
+class SemicolonParser(DirListParser):
+    """Semicolon-separated listings of path, timestamp and size in KiB."""
+
+    def sniff(self, head):
+        return ';' in head
+
+    def iter_assets(self, lines, sourcefile):
+        for n, line in enumerate(lines):
+            cols = line.split(';')
+            if cols[2] == 'Directory':
+                continue
+            else:
+                filename = os.path.basename(cols[0].rsplit('\\')[-1])
+                timestamp = parse_timestamp(cols[1], '%m/%d/%Y %I:%M:%S %p')
+                bytes = round(float(cols[2].replace(',', '')) * 1024)
+                yield Asset(filename=filename, bytes=bytes,
+                            timestamp=timestamp, sourcefile=sourcefile,
+                            sourceline=n)
+
+
+class DelimitedParser(DirListParser):
+    """CSV and TSV inventories with a header row naming the columns."""
+
+    possible_keys = {
+        'filename': ['Filename', 'File Name', 'FILENAME', 'Key',
+                     '"Filename"', '"Key"'],
+        'bytes': ['Size', 'SIZE', 'File Size', 'Bytes', 'BYTES',
+                  '"Size"'],
+        'timestamp': ['Mod Date', 'Moddate', 'MODDATE', '"Mod Date"'],
+        'md5': ['MD5', 'Other', 'Data', '"Other"', '"Data"', 'md5']
+        }
+
+    nondigits = re.compile(r'\D')
+
+    def sniff(self, head):
+        return True
+
+    def operative_keys(self, columns):
+        """Map each attribute to the column holding it in this file."""
+        operative_keys = {}
+        for attribute, keys in self.possible_keys.items():
+            for key in keys:
+                if key in columns:
+                    operative_keys[attribute] = key.replace('"','')
+                    break
+        return operative_keys
+
+    def iter_assets(self, lines, sourcefile):
+        lines = iter(lines)
+        head = next(lines)
+        delimiter = '\t' if '\t' in head else ','
+        columns = head.split(delimiter)
+        operative_keys = self.operative_keys(columns)
+        filename_key = operative_keys.get('filename')
+        bytes_key = operative_keys.get('bytes')
+        timestamp_key = operative_keys.get('timestamp')
+        md5_key = operative_keys.get('md5')
+        reader = csv.DictReader(chain([head], lines),
+                                quotechar='"',
+                                delimiter=delimiter
+                                )
+        for n, row in enumerate(reader):
+            # Skip extra rows in Prange-style "CSV" files
+            if 'File Name' in row and any([
+                (row.get('Type') == 'Directory'),
+                (row.get('File Name').startswith('Extension')),
+                (row.get('File Name').startswith('Total file size')),
+                (row.get('File Name') == '')
+                ]):
+                continue
+            else:
+                if filename_key is not None:
+                    filename = row[filename_key]
+                else:
+                    filename = None
+
+                if bytes_key is not None:
+                    digits = self.nondigits.sub('', row[bytes_key])
+                    if digits != '':
+                        bytes = int(digits)
                     else:
                         bytes = None
+                else:
+                    bytes = None
 
-                    timestamp_key = operative_keys.get('timestamp')
-                    if timestamp_key is not None:
-                        timestamp = row[timestamp_key]
-                    else:
-                        timestamp = None
+                if timestamp_key is not None:
+                    timestamp = row[timestamp_key]
+                else:
+                    timestamp = None
 
-                    md5_key = operative_keys.get('md5')
-                    if md5_key is not None:
-                        md5 = row[md5_key]
-                    else:
-                        md5 = None
-                    results.append(
-                        Asset(filename=filename, bytes=bytes,
-                              timestamp=timestamp, md5=md5,
-                              sourcefile=self.filename, sourceline=n)
-                        )
-            return results
+                if md5_key is not None:
+                    md5 = row[md5_key]
+                else:
+                    md5 = None
+                yield Asset(filename=filename, bytes=bytes,
+                            timestamp=timestamp, md5=md5,
+                            sourcefile=sourcefile, sourceline=n)
+
+
+DEFAULT_PARSER = DelimitedParser()
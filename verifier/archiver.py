@@ -1,7 +1,144 @@
+from concurrent.futures import ThreadPoolExecutor
+import csv
 import json
 import os
+import pickle
+import shutil
 import yaml
 
+from .utils import HashCache
+from .utils import atomic_write
+
+class BatchSpool():
+    """
+    Manifest and deaccession files written asset by asset while a batch is
+    streamed, to be moved into the package once the batch is complete.
+    """
+
+    def __init__(self, root, identifier):
+        self.path = os.path.join(root, 'spool', identifier)
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        self.manifest = open(os.path.join(self.path, "manifest.txt"), 'w')
+        self.deaccess = open(os.path.join(self.path, "deaccessions.txt"), 'w')
+
+    def write(self, asset):
+        """Record a found asset and any extra copies of it."""
+        self.manifest.write(f"{asset.md5} {asset.restored.path}\n")
+        for extra_copy in asset.extra_copies:
+            self.deaccess.write(f"duplicate {asset.md5} {extra_copy.path}\n")
+
+    def close(self):
+        self.manifest.close()
+        self.deaccess.close()
+
+    def discard(self):
+        self.close()
+        shutil.rmtree(self.path)
+
+
+class ActionSpool():
+    """
+    Actions for the assets of a streamed batch that are not kept in memory,
+    written as the batch is verified and read back by Batch.file_actions
+    and Batch.instance_actions.
+    """
+
+    def __init__(self, root, identifier):
+        spool_root = os.path.join(root, 'spool')
+        if not os.path.exists(spool_root):
+            os.makedirs(spool_root)
+        self.path = os.path.join(spool_root, f'{identifier}.actions.csv')
+        self.handle = open(self.path, 'w', newline='')
+        self.writer = csv.writer(self.handle)
+
+    def write(self, asset):
+        for id, action in asset.file_actions():
+            self.writer.writerow(('file', id, action))
+        self.writer.writerow(('instance', asset.sourcefile, asset.sourceline,
+                              asset.instance_action))
+
+    def close(self):
+        self.handle.close()
+
+
+# Layout of saved checkpoints; bump it whenever the batches they hold
+# change shape, so that checkpoints written by older code are not loaded
+CHECKPOINT_FORMAT = 2
+
+
+class CheckpointStore():
+    """
+    Verification results saved batch by batch in the package directory, so
+    that an interrupted or repeated run only verifies batches whose
+    dirlists, exclusions or restored files database have changed.  Each
+    checkpoint is keyed by the checkpoint format, the path, size, mtime and
+    inode of the batch's dirlists (as the hash cache keys them, so no
+    dirlist has to be read to check a checkpoint), the exclude patterns and
+    a fingerprint of the database file.  The key is pickled ahead of the
+    results, so a checkpoint can be checked without loading its batch.
+    """
+
+    def __init__(self, root, database_path):
+        self.path = os.path.join(root, 'checkpoints')
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        self.fingerprint = self.database_fingerprint(database_path)
+
+    @staticmethod
+    def database_fingerprint(path):
+        """Size and mtime of the database and of its write-ahead log."""
+        fingerprint = []
+        for name in [path, f'{path}-wal']:
+            if os.path.exists(name):
+                stat = os.stat(name)
+                fingerprint.append((stat.st_size, stat.st_mtime_ns))
+        return tuple(fingerprint)
+
+    def key(self, item):
+        batchname, paths, hashes, exclude_patterns, spool_root, actions = item
+        dirlists = sorted(HashCache.key(path) for path in paths)
+        return (CHECKPOINT_FORMAT, tuple(dirlists), tuple(exclude_patterns),
+                self.fingerprint)
+
+    def checkpoint_path(self, item):
+        return os.path.join(self.path, f'{item[0]}.pickle')
+
+    def is_current(self, item):
+        """True if a work item has an up-to-date checkpoint."""
+        path = self.checkpoint_path(item)
+        if not os.path.exists(path):
+            return False
+        try:
+            with open(path, 'rb') as handle:
+                return pickle.load(handle) == self.key(item)
+        except Exception:
+            return False
+
+    def load(self, item):
+        """
+        Return the saved (batch, complete, messages) for a work item, or
+        None if there is no checkpoint for it or the checkpoint is stale.
+        """
+        path = self.checkpoint_path(item)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, 'rb') as handle:
+                if pickle.load(handle) != self.key(item):
+                    return None
+                return pickle.load(handle)
+        except Exception:
+            return None
+
+    def save(self, item, batch, complete, messages):
+        with atomic_write(self.checkpoint_path(item), 'wb') as handle:
+            pickle.dump(self.key(item), handle,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+            pickle.dump((batch, complete, messages), handle,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+
+
 class Package():
     """
     Class representing a serialized upload package 
@@ -17,15 +154,34 @@ class Package():
     def add(self, batch):
         self.batches.append(batch)
 
-    def serialize_batches(self):
-        for batch in self.batches:
-            batch_path = os.path.join(self.root, "batches", batch.identifier)
-            #print(batch_path)
-            if not os.path.exists(batch_path):
-                os.makedirs(batch_path)
-            manifest = open(os.path.join(batch_path, "manifest.txt"), 'w')
-            deaccess = open(os.path.join(batch_path, "deaccessions.txt"), 'w')
-            missing  = open(os.path.join(batch_path, "missing.txt"), 'w')
+    def serialize_batches(self, workers=8):
+        """
+        Write the files of every batch, several batches at a time, and then
+        the master batches.yml.  Every file is written to a temporary file
+        and renamed into place, so none is ever left half written.
+        """
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(self.serialize_batch, self.batches))
+        self.write_master_package_yaml(os.path.join(self.root, 'batches.yml'))
+        spool_root = os.path.join(self.root, 'spool')
+        if os.path.isdir(spool_root) and not os.listdir(spool_root):
+            os.rmdir(spool_root)
+
+    def serialize_batch(self, batch):
+        batch_path = os.path.join(self.root, "batches", batch.identifier)
+        os.makedirs(batch_path, exist_ok=True)
+        if batch.spool is not None:
+            # streamed batches were written out as they were verified
+            for name in ["manifest.txt", "deaccessions.txt"]:
+                os.replace(os.path.join(batch.spool, name),
+                           os.path.join(batch_path, name))
+            with atomic_write(os.path.join(batch_path, "missing.txt")):
+                pass
+            os.rmdir(batch.spool)
+            return
+        with atomic_write(os.path.join(batch_path, "manifest.txt")) as manifest, \
+             atomic_write(os.path.join(batch_path, "deaccessions.txt")) as deaccess, \
+             atomic_write(os.path.join(batch_path, "missing.txt")) as missing:
             for asset in batch.assets:
                 if asset.status == 'Found':
                     manifest.write(f"{asset.md5} {asset.restored.path}\n")
@@ -41,12 +197,6 @@ class Package():
                     missing.write(
                         f"{asset.md5} {asset.bytes} {asset.filename}\n"
                         )
-            manifest.close()
-            deaccess.close()
-            missing.close()
-            self.write_master_package_yaml(
-                os.path.join(self.root, 'batches.yml')
-                )
 
     def write_master_package_yaml(self, path):
         data = {'batches_dir': 'batches',
@@ -56,7 +206,7 @@ class Package():
             data['batches'].append({'path': batch.identifier,
                                     'asset_root': batch.asset_root,
                                     'bucket': ''})
-        with open(path, 'w') as handle:
+        with atomic_write(path) as handle:
             yaml.dump(data, handle, indent=4)
 
     def write_summary(self):
@@ -1,3 +1,3 @@
 CREATE INDEX md5_lookup on files(md5);
-CREATE INDEX filename_lookup on files(filename);
-CREATE INDEX namesize_lookup on files(filename, bytes);
\ No newline at end of file
+CREATE INDEX namesizemd5_lookup on files(filename, bytes, md5);
+CREATE INDEX sourcefile_lookup on files(sourcefile);
@@ -1,13 +1,35 @@
 #!/usr/bin/env python3
 
+"""
+Load the restored file lists under SEARCH_ROOT into the files table of a
+restored files database.
+
+This script uses the verifier package, so run it as a module from the
+repository root or with the package installed (pip install -e .):
+
+    python -m verifier.db.load_restored_files_db DB [--bulk] ...
+"""
+
+import argparse
 import csv
-import hashlib
+import itertools
 import os
 import re
 import sqlite3
-import sys
 import uuid
 
+from verifier.restores import REDUNDANT_INDEXES
+from verifier.utils import HashCache
+from verifier.utils import calculate_md5
+from verifier.utils import hash_files
+from verifier.utils import prefetch
+
+
+INDEXES = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       'create_indexes.sql')
+
+# Number of rows sent to the database per executemany in bulk mode
+BULK_BATCH_SIZE = 100000
 
 SEARCH_ROOT = "/Users/westgard/Box Sync/AWSMigration" + \
               "/aws-migration-data/RestoredFilesEnhanced/"
@@ -46,21 +68,6 @@ shares = [
 ]
 
 
-def calculate_md5(path):
-    """
-    Calclulate and return the object's md5 hash.
-    """
-    hash = hashlib.md5()
-    with open(path, 'rb') as f:
-        while True:
-            data = f.read(8192)
-            if not data:
-                break
-            else:
-                hash.update(data)
-    return hash.hexdigest()
-
-
 def human_readable(bytes):
     for n, label in enumerate(['bytes', 'KiB', 'MiB', 'GiB', 'TiB']):
         value = bytes / (1024 ** n)
@@ -89,13 +96,15 @@ class RestoredFileList():
     md5, path, filename, size in btyes.
     """
 
-    def __init__(self, path, share, cursor):
+    def __init__(self, path, share, cursor, md5=None, load=True, rows=None):
+        self.path     = path
+        self.prefetched = rows
         self.filename = os.path.basename(path)
         self.share    = share.name
         self.prefix   = share.prefix
         self.suffix   = share.suffix
         self.bucket   = share.bucket
-        self.md5      = calculate_md5(path)
+        self.md5      = md5 if md5 is not None else calculate_md5(path)
 
         # Extract the label attched to the batch at transfer time
         if self.filename.startswith(self.prefix) and self.filename.endswith(self.suffix):
@@ -108,13 +117,34 @@ class RestoredFileList():
         self.id = self.insert(cursor)
 
         # Read the contents of the file and create asset objects
-        with open(path) as handle:
-            reader = csv.reader(handle)
+        if load:
             self.contents = []
-            for n, row in enumerate(reader, 1):
+            for n, row in enumerate(self.read_rows(), 1):
                 asset = Asset(n, self.id, *row)
                 self.contents.append(asset)
 
+    def read_rows(self):
+        """
+        Yield the csv rows of the list, from the rows passed in if it was
+        read ahead and otherwise from the file.
+        """
+        if self.prefetched is not None:
+            rows, self.prefetched = self.prefetched, None
+            yield from rows
+        else:
+            with open(self.path) as handle:
+                yield from csv.reader(handle)
+
+    def rows(self):
+        """
+        Stream the list's contents as rows for the files table without
+        creating asset objects.  Rows are keyed by list id and line number
+        rather than a random uuid.
+        """
+        for n, (md5, path, filename, bytes) in enumerate(self.read_rows(), 1):
+            yield (f'{self.id}-{n}', int(bytes), md5, filename, path,
+                   n, self.id)
+
     def insert(self, cursor):
         data = (self.md5, self.filename, self.share, self.batch)
         query = '''INSERT INTO dirlists (md5, filename, share, batch) 
@@ -212,29 +242,154 @@ def generate_overview_report(shares):
     print(f'Total Files: {totalfiles}')
 
 
-def main():
+def read_list(path):
+    """Read the csv rows of a restored file list, for reading ahead."""
+    with open(path) as handle:
+        return list(csv.reader(handle))
+
+
+def drop_indexes(con):
+    """
+    Drop the lookup indexes defined in create_indexes.sql, along with any
+    redundant ones left by older versions of it.
+    """
+    with open(INDEXES) as handle:
+        names = re.findall(r'CREATE INDEX (?:IF NOT EXISTS )?(\w+)',
+                           handle.read())
+    for name in names + REDUNDANT_INDEXES:
+        con.execute(f'DROP INDEX IF EXISTS {name};')
+
+
+def create_indexes(con):
+    """Build the lookup indexes defined in create_indexes.sql."""
+    with open(INDEXES) as handle:
+        con.executescript(handle.read())
+
+
+def bulk_load(con, r, ins):
+    """Insert a file list's rows in large batches without buffering it."""
+    rows = r.rows()
+    while True:
+        chunk = list(itertools.islice(rows, BULK_BATCH_SIZE))
+        if not chunk:
+            break
+        con.executemany(ins, chunk)
+
+
+def recorded_lists(con):
+    """Return a dict mapping (share, filename) to (id, md5) of loaded lists."""
+    query = '''SELECT id, md5, share, filename FROM dirlists;'''
+    return {(share, filename): (id, md5)
+            for id, md5, share, filename in con.execute(query)}
+
+
+def is_loaded(recorded, share, path, md5):
+    """True if the list at path was already loaded for share as it is now."""
+    previous = recorded.get((share.name, os.path.basename(path)))
+    return previous is not None and previous[1] == md5
+
+
+def remove_list(con, id):
+    """Delete a file list and all of its rows from the database."""
+    con.execute('''DELETE FROM files WHERE sourcefile=?;''', (id,))
+    con.execute('''DELETE FROM dirlists WHERE id=?;''', (id,))
+
+
+def clear_lists(con):
+    """Delete every file list and all of their rows from the database."""
+    con.execute('''DELETE FROM files;''')
+    con.execute('''DELETE FROM dirlists;''')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('db', help='path to the restored files database')
+    parser.add_argument('--hash-cache',
+                        help='path to a persistent cache of file list hashes '
+                             '(defaults to hashes.db next to the database)')
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--bulk', action='store_true',
+                      help='fast full reload: replace all loaded lists, '
+                           'defer indexes, relax syncing')
+    mode.add_argument('--incremental', action='store_true',
+                      help='only load lists that are new or have changed')
+    parser.add_argument('--prefetch', type=int, metavar='N',
+                        help='lists to read ahead in background threads '
+                             'while loading (0 to disable; defaults to 4, '
+                             'or 0 with --bulk)')
+    args = parser.parse_args(argv)
+    if args.prefetch is None:
+        # bulk loads stream each list, which reading ahead would buffer whole
+        args.prefetch = 0 if args.bulk else 4
+
     # establish database connection
     total_deposits = 0
-    db = sys.argv[1]
-    con = sqlite3.connect(db)
+    con = sqlite3.connect(args.db)
+    # lists are only hashed again when their size, mtime or inode change
+    cache = HashCache(args.hash_cache or os.path.join(
+        os.path.dirname(os.path.abspath(args.db)), 'hashes.db'
+        ))
     ins = '''INSERT INTO files(uuid, bytes, md5, filename, path, sourceline, sourcefile)         
                 VALUES (?, ?, ?, ?, ?, ?, ?);'''
 
+    if args.bulk:
+        # indexes are rebuilt once at the end rather than maintained per row
+        con.execute('PRAGMA journal_mode=WAL;')
+        con.execute('PRAGMA synchronous=OFF;')
+        con.execute('PRAGMA temp_store=MEMORY;')
+        con.execute('PRAGMA cache_size=-262144;')
+        # a reload replaces whatever an earlier load left behind
+        with con:
+            clear_lists(con)
+            drop_indexes(con)
+
+    if args.incremental:
+        recorded = recorded_lists(con)
+
     # process each main directory
     for item in shares:
         share = ShareDirectory(**item)
         sharepath = os.path.join(SEARCH_ROOT, share.share)
+        filepaths = [os.path.join(sharepath, f) for f in os.listdir(sharepath)]
+        hashes = hash_files(filepaths, cache)
+        if args.incremental:
+            filepaths = [f for f in filepaths
+                         if not is_loaded(recorded, share, f, hashes[f])]
+        # read upcoming lists while the current one is inserted
+        if args.prefetch:
+            contents = prefetch(read_list, filepaths, args.prefetch)
+        else:
+            contents = (None for filepath in filepaths)
         # process each dirlist
-        for f in os.listdir(sharepath):
-            filepath = os.path.join(sharepath, f)
+        for filepath, rows in zip(filepaths, contents):
+            if args.incremental:
+                previous = recorded.get((share.name, os.path.basename(filepath)))
+                if previous is not None:
+                    print(f'Replacing changed list {filepath}')
+                    with con:
+                        remove_list(con, previous[0])
             print(filepath)
-            r = RestoredFileList(filepath, share, con.cursor())
+            if args.bulk:
+                with con:
+                    r = RestoredFileList(filepath, share, con.cursor(),
+                                         md5=hashes[filepath], load=False,
+                                         rows=rows)
+                    bulk_load(con, r, ins)
+                continue
+
+            r = RestoredFileList(filepath, share, con.cursor(),
+                                 md5=hashes[filepath], rows=rows)
             
             with con:
                 data = [(a.uuid, a.bytes, a.md5, a.filename, a.path, a.sourceline,
                             a.sourcefile) for a in r.contents]
                 con.executemany(ins, data)
 
+    if args.bulk:
+        print('Building indexes...')
+        create_indexes(con)
+        con.execute('PRAGMA synchronous=FULL;')
+
     con.close()
 
 if __name__ == "__main__":
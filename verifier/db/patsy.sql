@@ -43,3 +43,5 @@ CREATE TABLE batches(
 CREATE INDEX md5_lookup on instances(md5);
 CREATE INDEX filename_lookup on instances(filename);
 CREATE INDEX namesize_lookup on instances(filename, bytes);
+CREATE INDEX instance_line_lookup on instances(dirlist_id, dirlist_line);
+CREATE INDEX dirlist_filename_lookup on dirlists(filename);
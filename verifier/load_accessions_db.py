@@ -1,15 +1,12 @@
 #!/usr/bin/env python3
 
 import os
-import sqlite3
 import sys
 import yaml
 
-from accessions import DirList
-from accessions import Batch
-from accessions import Asset
-
-from restores import Database
+from .accessions import DirList
+from .accessions import Batch
+from .restores import Database
 
 
 def main():
@@ -18,39 +15,51 @@ def main():
         config = yaml.safe_load(handle)
     source_root = os.path.join(config['ROOTDIR'], config['SOURCEDIR'])
     database = Database(os.path.join(config['ROOTDIR'], config['DATABASE']))
-    exclude_patterns = config['EXCLUDES']
 
     batches = {}
     for file in os.listdir(source_root):
         try:
             batchname, date, extra = file.split('_', 2)
-            dirlist = DirList(os.path.join(source_root, file))
-            batches.setdefault(batchname, []).append(dirlist)
+            batches.setdefault(batchname, []).append(
+                os.path.join(source_root, file)
+                )
         except ValueError:
             sys.stdout.write(f"Could not parse file: {file}\n")
             sys.exit(1)
 
     for batchname in sorted(batches.keys()):
         print(f'\n{batchname.upper()}\n{"=" * len(batchname)}')
-        batch = Batch(batchname, *batches[batchname])
-        exists = database.lookup_batch(batch)
-        if len(exists) == 1:
-            id = exists[0][0]
-            print(f"  Using existing batch {batch.identifier}... id = {id}")
-        elif len(exists) > 1:
-            sys.exit('too many matches')
-        else:
-            id = database.save_batch(batch)
-            print(f"  Creating {batch.identifier}... id = {id}")
-        print(f"  Source Files: {len(batch.dirlists)}")
-        for n, dirlist in enumerate(batch.dirlists, 1):
-            print(f"    ({n}) {dirlist.filename}: {len(dirlist.lines)} lines")
-            dirlist_id = database.create_dirlist(dirlist, id)
-        print(f"  Total Assets: {len(batch.assets)}")
-        print(f"  Processing batch assets...")
-        for n, asset in enumerate(batch.assets, 1):
-            dirlist_id = database.lookup_dirlist_by_name(asset.sourcefile)
-            asset_id = database.create_asset(asset, dirlist_id)
+        batch = Batch(batchname, *[DirList(p) for p in batches[batchname]])
+
+        # register the batch and its dirlists and load all of its assets
+        # in one transaction, so a failed batch leaves nothing behind
+        with database.connection:
+            exists = database.lookup_batch(batch)
+            if len(exists) == 1:
+                id = exists[0][0]
+                print(f"  Using existing batch {batch.identifier}... id = {id}")
+            elif len(exists) > 1:
+                sys.exit('too many matches')
+            else:
+                id = database.create_batch(batch)
+                print(f"  Creating {batch.identifier}... id = {id}")
+            print(f"  Source Files: {len(batch.dirlists)}")
+            dirlist_ids = {}
+            for n, dirlist in enumerate(batch.dirlists, 1):
+                print(f"    ({n}) {dirlist.filename}: {dirlist.line_count} lines")
+                dirlist_ids[dirlist.filename] = database.create_dirlist(
+                    dirlist, id
+                    )
+            print(f"  Total Assets: {len(batch.assets)}")
+            print(f"  Processing batch assets...")
+            database.create_assets(
+                (asset.filename, asset.md5, asset.bytes,
+                 dirlist_ids[asset.sourcefile], asset.sourceline)
+                for asset in batch.assets
+                )
+
+    print(f"Building indexes...")
+    database.create_accession_indexes()
 
 
 if __name__ == "__main__":
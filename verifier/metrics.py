@@ -0,0 +1,108 @@
+from contextlib import contextmanager
+from functools import wraps
+import threading
+import time
+
+
+# Guards updates from threads sharing a process's metrics
+_lock = threading.Lock()
+
+
+class Metrics():
+    """
+    Wall time and item counts for each stage of a run, and call counts and
+    latency histograms for instrumented functions.  Histogram buckets are
+    powers of two in microseconds, given as [upper bound, count] pairs.
+    Stages may nest, as parse and match do within verify.  Metrics gathered
+    in worker processes are sent back and merged, so their stage times are
+    summed over the workers.
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.calls = {}
+
+    @contextmanager
+    def stage(self, name, items=0):
+        """Time a block as part of a stage, adding items to its count."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start, items)
+
+    def add(self, name, seconds=0.0, items=0):
+        with _lock:
+            stage = self.stages.setdefault(name, {'seconds': 0.0, 'items': 0})
+            stage['seconds'] += seconds
+            stage['items'] += items
+
+    def observe(self, name, seconds):
+        """Record the latency of one call to name."""
+        bucket = 2 ** int(seconds * 1000000).bit_length()
+        with _lock:
+            call = self.calls.get(name)
+            if call is None:
+                call = self.calls[name] = {'count': 0, 'seconds': 0.0,
+                                           'max': 0.0, 'histogram': {}}
+            call['count'] += 1
+            call['seconds'] += seconds
+            if seconds > call['max']:
+                call['max'] = seconds
+            call['histogram'][bucket] = call['histogram'].get(bucket, 0) + 1
+
+    def merge(self, other):
+        for name, stage in other.stages.items():
+            self.add(name, stage['seconds'], stage['items'])
+        for name, other_call in other.calls.items():
+            call = self.calls.setdefault(name, {'count': 0, 'seconds': 0.0,
+                                                'max': 0.0, 'histogram': {}})
+            call['count'] += other_call['count']
+            call['seconds'] += other_call['seconds']
+            call['max'] = max(call['max'], other_call['max'])
+            for bucket, count in other_call['histogram'].items():
+                call['histogram'][bucket] = \
+                    call['histogram'].get(bucket, 0) + count
+
+    def reset(self):
+        self.stages = {}
+        self.calls = {}
+
+    def as_dict(self):
+        stages = {}
+        for name, stage in self.stages.items():
+            seconds = stage['seconds']
+            stages[name] = {
+                'seconds': round(seconds, 6),
+                'items': stage['items'],
+                'items_per_sec': round(stage['items'] / seconds)
+                                 if seconds else None
+                }
+        calls = {}
+        for name, call in self.calls.items():
+            calls[name] = {
+                'count': call['count'],
+                'seconds': round(call['seconds'], 6),
+                'mean_us': round(call['seconds'] / call['count'] * 1000000, 1),
+                'max_us': round(call['max'] * 1000000, 1),
+                'histogram_us': sorted(call['histogram'].items())
+                }
+        return {'stages': stages, 'calls': calls}
+
+
+# Metrics of the current process
+METRICS = Metrics()
+
+
+def timed(name):
+    """Decorator recording the latency of each call under name."""
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                METRICS.observe(name, time.perf_counter() - start)
+        return wrapper
+    return decorator
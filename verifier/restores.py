@@ -1,44 +1,410 @@
+from collections import namedtuple
+import os
+import re
 import sqlite3
+from urllib.request import pathname2url
+
+from .metrics import timed
+
+
+# Columns of the files table that make up a RestoredAsset
+RESTORED_COLUMNS = "uuid, bytes, md5, filename, path"
+
+# Indexes the match queries and the replacement of changed restored file
+# lists depend on; keep in step with create_indexes.sql.  Lookups by
+# filename and by (filename, bytes) use prefixes of namesizemd5_lookup,
+# which is not a covering index: uuid and path are read from the table row
+# of each match.
+INDEXES = {
+    'md5_lookup':         'files(md5)',
+    'namesizemd5_lookup': 'files(filename, bytes, md5)',
+    'sourcefile_lookup':  'files(sourcefile)'
+    }
+
+# Indexes made redundant by prefixes of namesizemd5_lookup, which older
+# databases may still carry
+REDUNDANT_INDEXES = ['filename_lookup', 'namesize_lookup']
+
+MATCH_QUERIES = {
+    'match_filename_bytes_md5': f"""
+        SELECT {RESTORED_COLUMNS} FROM files
+         WHERE filename=? and md5=? and bytes=?;
+        """,
+    'match_filename_bytes': f"""
+        SELECT {RESTORED_COLUMNS} FROM files WHERE filename=? and bytes=?;
+        """,
+    'match_filename': f"""
+        SELECT {RESTORED_COLUMNS} FROM files WHERE filename=?;
+        """
+    }
+
+# Join conditions used by match_batch for each kind of asset signature;
+# md5s are compared by the caller, so one lookup finds both perfect and
+# altered copies
+BATCH_CONDITIONS = {
+    'f':   """f.filename = s.filename""",
+    'fb':  """f.filename = s.filename and f.bytes = s.bytes"""
+    }
+
+BATCH_QUERY = """
+    SELECT s.seq, f.uuid, f.bytes, f.md5, f.filename, f.path
+      FROM batch_signatures s JOIN files f ON {condition}
+     WHERE s.mode = ?
+     ORDER BY s.seq, f.rowid;
+    """
+
+# Anti-join of the files table against the ids of matched files, giving the
+# restored files not accounted for by any accession in a single scan;
+# excluded and invisible files are discards rather than x-files
+UNMATCHED_QUERY = """
+    SELECT d.share, d.batch, f.md5, f.bytes, f.path
+      FROM files f LEFT JOIN dirlists d ON d.id = f.sourcefile
+     WHERE NOT EXISTS (SELECT 1 FROM matched_files m WHERE m.id = f.uuid)
+       AND NOT {excluded}
+     ORDER BY f.rowid;
+    """
+
+
+def excluded_condition(exclude_patterns, column='filename'):
+    """
+    Return SQL true for the files that verify.is_excluded would exclude,
+    with its parameters: excluded filenames and invisible files.
+    """
+    placeholders = ', '.join('?' * len(exclude_patterns))
+    condition = f"""coalesce({column} IN ({placeholders})
+                             OR {column} LIKE '.%', 0)"""
+    return condition, list(exclude_patterns)
+
+
+# Precedence of the actions a batch can give one restored file
+FILE_ACTION_RANKS = {'duplicate': 1, 'altered': 2, 'transfer': 3}
+
+# Rank of the action already stored for a file; other actions, such as
+# those left by the unmatched pass of an earlier run, rank below them all
+STORED_ACTION_RANK = 'CASE f.action {} ELSE 0 END'.format(' '.join(
+    f"WHEN '{action}' THEN {rank}" for action, rank in FILE_ACTION_RANKS.items()
+    ))
+
+# Applies the actions loaded into batch_file_actions, looking each file up
+# by its id.  A file keeps the action given by an earlier batch unless the
+# new one ranks higher
+FILE_ACTIONS_UPDATE = f"""
+    UPDATE files SET action = (
+        SELECT b.action FROM batch_file_actions b WHERE b.id = files.uuid
+        )
+     WHERE rowid IN (
+        SELECT f.rowid
+          FROM batch_file_actions b
+         CROSS JOIN files f
+         WHERE f.uuid = b.id
+           AND (f.action IS NULL OR b.rank > {STORED_ACTION_RANK})
+        );
+    """
+
+# Applies the actions loaded into batch_instance_actions.  The CROSS JOINs
+# keep the loaded actions in the outer loop, so that with the indexes made
+# by create_instance_indexes each action costs a few indexed lookups rather
+# than the planner choosing a scan of the instances table
+INSTANCE_ACTIONS_UPDATE = """
+    UPDATE instances SET action = (
+        SELECT a.action
+          FROM dirlists d JOIN batch_instance_actions a
+            ON a.filename = d.filename
+         WHERE d.id = instances.dirlist_id
+           AND a.line = instances.dirlist_line
+        )
+     WHERE rowid IN (
+        SELECT i.rowid
+          FROM batch_instance_actions a
+         CROSS JOIN dirlists d
+         CROSS JOIN instances i
+         WHERE d.filename = a.filename
+           AND i.dirlist_id = d.id
+           AND i.dirlist_line = a.line
+        );
+    """
+
 
 class Database():
 
-    def __init__(self, path):
-        self.connection = sqlite3.connect(path)
+    def __init__(self, path, readonly=False):
+        self.readonly = readonly
+        if readonly:
+            uri = f'file:{pathname2url(os.path.abspath(path))}?mode=ro'
+            self.connection = sqlite3.connect(uri, uri=True, timeout=60,
+                                              cached_statements=256)
+        else:
+            self.connection = sqlite3.connect(path, timeout=60,
+                                              cached_statements=256)
+            # WAL lets read-only verifier processes share the file with a
+            # writer without blocking each other
+            self.connection.execute('PRAGMA journal_mode=WAL;')
+        self.connection.execute('PRAGMA mmap_size=1073741824;')
+        self.connection.execute('PRAGMA cache_size=-131072;')
+        self.connection.execute('PRAGMA temp_store=MEMORY;')
         self.cursor = self.connection.cursor()
     
     def __del__(self):
-        self.connection.commit()
-        self.connection.close()
+        self.close()
+
+    def close(self):
+        if self.connection is not None:
+            if not self.readonly:
+                self.connection.commit()
+            self.connection.close()
+            self.connection = None
 
     def match_filename_bytes_md5(self, asset):
-        query = """
-            SELECT * FROM files WHERE filename=? and md5=? and bytes=?;
-            """
+        query = MATCH_QUERIES['match_filename_bytes_md5']
         signature = (asset.filename, asset.md5, asset.bytes)
         results = self.cursor.execute(query, signature).fetchall()
         if results:
-            return [RestoredAsset(*r[:5]) for r in results]
+            return [RestoredAsset._make(r) for r in results]
         else:
             return None
 
     def match_filename_bytes(self, asset):
-        query = """SELECT * FROM files WHERE filename=? and bytes=?;"""
+        query = MATCH_QUERIES['match_filename_bytes']
         signature = (asset.filename, asset.bytes)
         results = self.cursor.execute(query, signature).fetchall()
         if results:
-            return [RestoredAsset(*r[:5]) for r in results]
+            return [RestoredAsset._make(r) for r in results]
         else:
             return None
 
     def match_filename(self, asset):
-        query = """SELECT * FROM files WHERE filename=?;"""
+        query = MATCH_QUERIES['match_filename']
         signature = (asset.filename,)
         results = self.cursor.execute(query, signature).fetchall()
         if results:
-            return [RestoredAsset(*r[:5]) for r in results]
+            return [RestoredAsset._make(r) for r in results]
         else:
             return None
 
+    @timed('Database.match_batch')
+    def match_batch(self, assets):
+        """
+        Resolve a sequence of assets against the files table in a few
+        set-based queries, returning a list of candidate copies (or None)
+        aligned with the input.  Each asset is matched on its filename and,
+        where it has them, its bytes; md5s are left for the caller to
+        compare.
+        """
+        self.create_signature_table()
+        self.cursor.execute("""DELETE FROM batch_signatures;""")
+        rows = []
+        for seq, asset in enumerate(assets):
+            mode = 'f' if asset.bytes is None else 'fb'
+            rows.append((seq, asset.filename, asset.md5, asset.bytes, mode))
+        self.cursor.executemany(
+            """INSERT INTO batch_signatures (seq, filename, md5, bytes, mode)
+                VALUES (?, ?, ?, ?, ?);""", rows
+            )
+
+        results = [None] * len(rows)
+        for mode, condition in BATCH_CONDITIONS.items():
+            query = BATCH_QUERY.format(condition=condition)
+            for seq, *r in self.cursor.execute(query, (mode,)):
+                if results[seq] is None:
+                    results[seq] = []
+                results[seq].append(RestoredAsset._make(r))
+        self.cursor.execute("""DELETE FROM batch_signatures;""")
+        if self.readonly:
+            # filling the temporary table opened a transaction; ending it
+            # stops the connection from holding an old snapshot of the
+            # database, which would keep a writer's log from being reset
+            self.connection.commit()
+        return results
+
+    def create_signature_table(self):
+        self.cursor.execute(
+            """CREATE TEMP TABLE IF NOT EXISTS batch_signatures (
+                    seq      INTEGER PRIMARY KEY,
+                    filename TEXT,
+                    md5      TEXT,
+                    bytes    INTEGER,
+                    mode     TEXT
+                    );"""
+            )
+
+    def add_matched_files(self, ids):
+        """Add file ids to the temporary matched_files table."""
+        self.cursor.execute(
+            """CREATE TEMP TABLE IF NOT EXISTS matched_files (
+                    id TEXT PRIMARY KEY
+                    ) WITHOUT ROWID;"""
+            )
+        self.cursor.executemany(
+            """INSERT OR IGNORE INTO matched_files (id) VALUES (?);""",
+            ((id,) for id in ids)
+            )
+
+    def unmatched_files(self, exclude_patterns):
+        """
+        Iterate over (share, batch, md5, bytes, path) for each restored
+        file whose id was not added with add_matched_files, other than
+        excluded and invisible ones: the x-files.
+        """
+        self.add_matched_files([])
+        condition, params = excluded_condition(exclude_patterns, 'f.filename')
+        query = UNMATCHED_QUERY.format(excluded=condition)
+        return self.connection.execute(query, params)
+
+    def record_file_actions(self, rows):
+        """
+        Set files.action from rows of (file id, action).  Where the rows,
+        or those of an earlier batch, give a file more than one action, a
+        transfer beats altered, which beats duplicate.  The rows are loaded
+        into a temporary table and applied in one update.
+        """
+        self.cursor.execute(
+            """CREATE TEMP TABLE IF NOT EXISTS batch_file_actions (
+                    id     TEXT PRIMARY KEY,
+                    action TEXT,
+                    rank   INTEGER
+                    ) WITHOUT ROWID;"""
+            )
+        self.cursor.execute("""DELETE FROM batch_file_actions;""")
+        self.cursor.executemany(
+            """INSERT INTO batch_file_actions (id, action, rank)
+                VALUES (?, ?, ?)
+                ON CONFLICT (id) DO UPDATE
+                   SET action = excluded.action, rank = excluded.rank
+                 WHERE excluded.rank > rank;""",
+            ((id, action, FILE_ACTION_RANKS[action]) for id, action in rows)
+            )
+        self.cursor.execute(FILE_ACTIONS_UPDATE)
+        self.cursor.execute("""DELETE FROM batch_file_actions;""")
+
+    def clear_file_actions(self):
+        self.cursor.execute(
+            """UPDATE files SET action = NULL WHERE action IS NOT NULL;"""
+            )
+
+    def record_unmatched_actions(self, exclude_patterns):
+        """
+        Set files.action, in one pass, for every file left without one
+        since clear_file_actions: 'discard' for excluded and invisible
+        filenames and 'x-file' for the rest.
+        """
+        condition, params = excluded_condition(exclude_patterns)
+        query = f"""UPDATE files SET action = CASE
+                        WHEN {condition} THEN 'discard'
+                        ELSE 'x-file' END
+                     WHERE action IS NULL;"""
+        self.cursor.execute(query, params)
+
+    def has_table(self, name):
+        query = """SELECT 1 FROM sqlite_master WHERE type='table' and name=?;"""
+        return self.cursor.execute(query, (name,)).fetchone() is not None
+
+    def create_instance_indexes(self):
+        """
+        Create the indexes record_instance_actions looks instances up by,
+        if the accessions database predates them.
+        """
+        self.connection.executescript(
+            """CREATE INDEX IF NOT EXISTS instance_line_lookup
+                   on instances(dirlist_id, dirlist_line);
+               CREATE INDEX IF NOT EXISTS dirlist_filename_lookup
+                   on dirlists(filename);"""
+            )
+
+    def record_instance_actions(self, rows):
+        """
+        Set instances.action from rows of (dirlist filename, line, action),
+        the last action given for a line winning.  The rows are loaded into
+        a temporary table and applied in one joined update.
+        """
+        self.cursor.execute(
+            """CREATE TEMP TABLE IF NOT EXISTS batch_instance_actions (
+                    filename TEXT,
+                    line     INTEGER,
+                    action   TEXT,
+                    PRIMARY KEY (filename, line)
+                    ) WITHOUT ROWID;"""
+            )
+        self.cursor.execute("""DELETE FROM batch_instance_actions;""")
+        self.cursor.executemany(
+            """INSERT OR REPLACE INTO batch_instance_actions
+                    (filename, line, action) VALUES (?, ?, ?);""", rows
+            )
+        self.cursor.execute(INSTANCE_ACTIONS_UPDATE)
+        self.cursor.execute("""DELETE FROM batch_instance_actions;""")
+
+    def index_names(self):
+        query = """SELECT name FROM sqlite_master WHERE type='index';"""
+        return set(r[0] for r in self.cursor.execute(query))
+
+    def missing_indexes(self):
+        """Return the names of managed indexes missing from the database."""
+        present = self.index_names()
+        return [name for name in INDEXES if name not in present]
+
+    def redundant_indexes(self):
+        """Return the names of redundant indexes present in the database."""
+        present = self.index_names()
+        return [name for name in REDUNDANT_INDEXES if name in present]
+
+    def drop_indexes(self, names):
+        for name in names:
+            self.cursor.execute(f"""DROP INDEX IF EXISTS {name};""")
+        self.connection.commit()
+
+    def create_indexes(self, names=None):
+        for name in (names if names is not None else INDEXES):
+            self.cursor.execute(
+                f"""CREATE INDEX IF NOT EXISTS {name} on {INDEXES[name]};"""
+                )
+        self.connection.commit()
+
+    def query_plans(self):
+        """
+        Return a dict mapping the name of each lookup query to the detail
+        lines of its EXPLAIN QUERY PLAN output.
+        """
+        self.create_signature_table()
+        queries = dict(MATCH_QUERIES)
+        for mode, condition in BATCH_CONDITIONS.items():
+            queries[f'match_batch ({mode})'] = BATCH_QUERY.format(
+                condition=condition
+                )
+        plans = {}
+        for name, query in queries.items():
+            params = (None,) * query.count('?')
+            plan = self.cursor.execute(
+                f"EXPLAIN QUERY PLAN {query}", params
+                ).fetchall()
+            plans[name] = [row[-1] for row in plan]
+        return plans
+
+    def check_indexes(self, create=False):
+        """
+        Check that the managed indexes exist and no redundant ones are left
+        (creating and dropping them if asked), and that no lookup query
+        falls back to a full scan of the files table.  Return a list of
+        warning messages, empty if all is well.
+        """
+        warnings = []
+        missing = self.missing_indexes()
+        redundant = self.redundant_indexes()
+        if create:
+            self.create_indexes(missing)
+            self.drop_indexes(redundant)
+        else:
+            for name in missing:
+                warnings.append(f"Missing index {name} on {INDEXES[name]}")
+            for name in redundant:
+                warnings.append(f"Redundant index {name}; lookups use "
+                                f"namesizemd5_lookup")
+        for name, details in self.query_plans().items():
+            for detail in details:
+                if re.match(r'SCAN (TABLE )?(files|f)\b', detail):
+                    warnings.append(f"{name} scans the files table: {detail}")
+                elif 'AUTOMATIC' in detail:
+                    warnings.append(f"{name} builds a temporary index: {detail}")
+        return warnings
+
     def lookup_batch(self, batch):
         query = """SELECT id FROM batches WHERE name=?;"""
         return self.cursor.execute(query, (batch.identifier,)).fetchall()
@@ -48,7 +414,6 @@ class Database():
         data = (batch.identifier,)
         id = self.cursor.execute(query, data).lastrowid
         if id:
-            self.connection.commit()
             return id
         else:
             return None
@@ -64,6 +429,28 @@ class Database():
         cur.execute(query, data)
         return cur.lastrowid
 
+    def create_assets(self, rows):
+        """
+        Insert many asset rows of (filename, md5, bytes, source_id,
+        source_line) in a single executemany.
+        """
+        query = """INSERT INTO assets 
+                    (filename, md5, bytes, source_id, source_line)
+                   VALUES (?, ?, ?, ?, ?)"""
+        self.connection.executemany(query, rows)
+
+    def create_accession_indexes(self):
+        self.connection.executescript(
+            """CREATE INDEX IF NOT EXISTS asset_md5_lookup
+                   on assets(md5);
+               CREATE INDEX IF NOT EXISTS asset_filename_lookup
+                   on assets(filename);
+               CREATE INDEX IF NOT EXISTS asset_namesize_lookup
+                   on assets(filename, bytes);
+               CREATE INDEX IF NOT EXISTS asset_source_lookup
+                   on assets(source_id);"""
+            )
+
     def create_dirlist(self, dirlist, batch_id):
         cur = self.connection.cursor()
         query = """INSERT INTO dirlists 
@@ -95,6 +482,62 @@ class Database():
         return cur.lastrowid
 
 
+class MatchIndex():
+    """
+    In-memory alternative to Database for answering match queries.  The
+    files table is read once into hash maps keyed by filename, (filename,
+    bytes) and (filename, md5, bytes).
+    """
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.by_filename = {}
+        self.by_filename_bytes = {}
+        self.by_filename_bytes_md5 = {}
+        for n, (id, bytes, md5, filename, path) in enumerate(rows):
+            self.by_filename.setdefault(filename, []).append(n)
+            self.by_filename_bytes.setdefault(
+                (filename, bytes), []).append(n)
+            self.by_filename_bytes_md5.setdefault(
+                (filename, bytes, md5), []).append(n)
+
+    @classmethod
+    def from_database(cls, path):
+        uri = f'file:{pathname2url(os.path.abspath(path))}?mode=ro'
+        connection = sqlite3.connect(uri, uri=True, timeout=60)
+        query = f"""SELECT {RESTORED_COLUMNS} FROM files ORDER BY rowid;"""
+        rows = [tuple(r) for r in connection.execute(query)]
+        connection.close()
+        return cls(rows)
+
+    def lookup(self, mapping, key):
+        positions = mapping.get(key)
+        if positions:
+            return [RestoredAsset._make(self.rows[n]) for n in positions]
+        else:
+            return None
+
+    def match_filename_bytes_md5(self, asset):
+        signature = (asset.filename, asset.bytes, asset.md5)
+        return self.lookup(self.by_filename_bytes_md5, signature)
+
+    def match_filename_bytes(self, asset):
+        signature = (asset.filename, asset.bytes)
+        return self.lookup(self.by_filename_bytes, signature)
+
+    def match_filename(self, asset):
+        return self.lookup(self.by_filename, asset.filename)
+
+    @timed('MatchIndex.match_batch')
+    def match_batch(self, assets):
+        lookup = self.lookup
+        by_filename = self.by_filename
+        by_filename_bytes = self.by_filename_bytes
+        return [lookup(by_filename, asset.filename) if asset.bytes is None
+                else lookup(by_filename_bytes, (asset.filename, asset.bytes))
+                for asset in assets]
+
+
 class Asset():
     pass
 
@@ -111,11 +554,5 @@ class Instance():
     pass
 
 
-class RestoredAsset():
-
-    def __init__(self, id, bytes, md5, filename, path):
-        self.id = id
-        self.bytes = bytes
-        self.md5 = md5
-        self.filename = filename
-        self.path = path
+# A row of the files table, kept as a light tuple with named fields
+RestoredAsset = namedtuple('RestoredAsset', 'id bytes md5 filename path')
@@ -1,10 +1,16 @@
 import csv
 import datetime
 import os
+import pickle
 import re
+import shelve
 
-from utils import md5checksum
-from utils import sniff_encoding
+from utils import read_inventory
+
+
+# Attributes of an AccessionRecord kept in the inventory cache; the source
+# file and hash are those of the inventory the record is loaded for
+RECORD_FIELDS = ('filename', 'sourceline', 'relpath', 'bytes', 'md5', 'mtime')
 
 
 class AccessionRecord():
@@ -30,20 +36,57 @@ class AccessionRecord():
 class InventoryFile():
     """Class representing a text file containing a set of accession records."""
 
-    def __init__(self, path):
+    def __init__(self, path, md5=None):
         self.path = path
         self.filename = os.path.basename(path)
-        self.encoding = sniff_encoding(self.path)
-        self.md5 = md5checksum(self.path)
-        with open(self.path, encoding=self.encoding) as handle:
-            self.lines = [
-                (n, line.rstrip('\n')) for n, line in enumerate(handle.readlines(), 1)
-                ]
+        self.md5, handle, self.encoding = read_inventory(self.path, md5)
+        self.head = handle.readline().rstrip('\n')
+        handle.seek(0)
         self.type = self.sniff_format()
         self.directories = []
         self.excludes = []
         self.accessions = []
-        self.read_accessions()
+        self.read_accessions(handle)
+
+    @classmethod
+    def from_cache(cls, path, md5, data):
+        """Rebuild an inventory from the data saved by to_cache."""
+        inventory = cls.__new__(cls)
+        inventory.path = path
+        inventory.filename = os.path.basename(path)
+        inventory.md5 = md5
+        inventory.encoding = data['encoding']
+        inventory.head = data['head']
+        inventory.type = data['type']
+        inventory.directories = data['directories']
+        inventory.excludes = data['excludes']
+        inventory.accessions = [
+            AccessionRecord(sourcefile=inventory.filename, sourcehash=md5,
+                            **dict(zip(RECORD_FIELDS, row)))
+            for row in data['accessions']
+            ]
+        return inventory
+
+    def to_cache(self):
+        """Return the parsed contents as plain data, records as tuples."""
+        return {'encoding': self.encoding,
+                'head': self.head,
+                'type': self.type,
+                'directories': self.directories,
+                'excludes': self.excludes,
+                'accessions': [tuple(getattr(a, f) for f in RECORD_FIELDS)
+                               for a in self.accessions]
+                }
+
+    @property
+    def lines(self):
+        """Yield (linenumber, line) tuples, reading the file afresh."""
+        md5, handle, encoding = read_inventory(self.path)
+        return self.numbered(handle)
+
+    @staticmethod
+    def numbered(handle):
+        return ((n, line.rstrip('\n')) for n, line in enumerate(handle, 1))
 
     def show(self):
         print(f'PATH: {self.path}')
@@ -56,7 +99,7 @@ class InventoryFile():
             accession.show()
 
     def sniff_format(self):
-        head = self.lines[0][1]
+        head = self.head
         if 'Volume in drive' in head:
             return 'dirlist-a'
         elif ';' in head:
@@ -69,7 +112,8 @@ class InventoryFile():
     def raw_lines(self):
         return [line_tuple[1] for line_tuple in self.lines]
 
-    def read_accessions(self):
+    def read_accessions(self, handle):
+        lines = self.numbered(handle)
 
         if self.type == 'dirlist-a':
             """
@@ -78,7 +122,7 @@ class InventoryFile():
             non-asset-listing lines being indented by two spaces. This format was used for 
             the earliest DCR dirlists.
             """
-            for linenumber, line in self.lines:
+            for linenumber, line in lines:
                 if line.startswith(' ') or line == '':
                     self.excludes.append(line)
                 else:
@@ -110,7 +154,8 @@ class InventoryFile():
             elif self.type == 'csv':
                 delimiter = ','
             
-            for linenumber, line in self.lines[1:]:
+            next(lines, None)
+            for linenumber, line in lines:
                 cols = line.split('\t')
                 if len(cols) <= 1:
                     self.excludes.append(line)
@@ -143,10 +188,41 @@ class InventoryFile():
             pass
 
 
+class InventoryCache():
+    """
+    Persistent cache of parsed inventories in a shelf.  Parsed contents are
+    keyed by the inventory's md5, and the md5 of each path is remembered
+    with its size, mtime and inode, so an unchanged file is loaded without
+    being read.  A changed file is read once, hashing it as it is parsed,
+    and the contents saved for its previous md5 are dropped.
+    """
 
-
-
-
-
-
-
+    def __init__(self, path):
+        self.shelf = shelve.open(path, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.shelf.close()
+
+    def load(self, path):
+        """Return the InventoryFile for path, parsing it only if needed."""
+        stat = os.stat(path)
+        signature = (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+        path_key = f'path:{os.path.abspath(path)}'
+        saved = self.shelf.get(path_key)
+        if saved is not None and saved[0] == signature:
+            data = self.shelf.get(f'md5:{saved[1]}')
+            if data is not None:
+                return InventoryFile.from_cache(path, saved[1], data)
+        inventory = InventoryFile(path)
+        if saved is not None and saved[1] != inventory.md5:
+            # another path with the same old contents will parse them again
+            self.shelf.pop(f'md5:{saved[1]}', None)
+        self.shelf[path_key] = (signature, inventory.md5)
+        self.shelf[f'md5:{inventory.md5}'] = inventory.to_cache()
+        return inventory
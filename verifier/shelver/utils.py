@@ -1,10 +1,46 @@
 import hashlib
+import io
+
+
+ENCODINGS = ['utf-8', 'latin-1']
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def read_inventory(path, md5=None):
+    """
+    Read an inventory in a single pass, hashing its bytes as they are read
+    and decoding them with the first encoding that succeeds.  Return a
+    tuple of (md5, handle, encoding), where handle is an in-memory text
+    stream; handle and encoding are None if no encoding could decode the
+    file.  If the file's md5 is already known hashing is skipped.
+    """
+    hash = hashlib.md5() if md5 is None else None
+    chunks = []
+    with open(path, 'rb') as fh:
+        while True:
+            data = fh.read(CHUNK_SIZE)
+            if not data:
+                break
+            else:
+                if hash is not None:
+                    hash.update(data)
+                chunks.append(data)
+    if hash is not None:
+        md5 = hash.hexdigest()
+    data = b''.join(chunks)
+    for encoding in ENCODINGS:
+        try:
+            text = data.decode(encoding)
+        except ValueError:
+            continue
+        return md5, io.StringIO(text, newline=None), encoding
+    return md5, None, None
 
 
 def sniff_encoding(path):
-    """Attempt to sniff and return the file's encoding.""" 
-    encodings = ['utf-8', 'latin-1']
-    for encoding in encodings:
+    """Attempt to sniff and return the file's encoding."""
+    for encoding in ENCODINGS:
         try:
             f = open(path, encoding=encoding)
             f.read()
@@ -20,7 +56,7 @@ def md5checksum(path):
     with open(path, 'rb') as fh:
         m = hashlib.md5()
         while True:
-            data = fh.read(8192)
+            data = fh.read(CHUNK_SIZE)
             if not data:
                 break
             else:
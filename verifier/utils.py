@@ -1,20 +1,329 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import codecs
 import hashlib
+import io
+from itertools import islice
+import os
+import sqlite3
+import tempfile
 
-def calculate_md5(path):
+
+# Read size for hashing; large reads let hashlib release the GIL for longer
+CHUNK_SIZE = 1024 * 1024
+
+# Process umask, applied to files made by atomic_write as open() would
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+
+class HashCache():
+    """
+    Persistent cache of md5 hashes stored in a small SQLite file and keyed
+    by path, size, modification time and inode, so that a file is only
+    hashed again when it has changed.
+    """
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            """CREATE TABLE IF NOT EXISTS hashes (
+                    path     TEXT PRIMARY KEY,
+                    bytes    INTEGER,
+                    mtime_ns INTEGER,
+                    inode    INTEGER,
+                    md5      TEXT
+                    );"""
+            )
+
+    def __del__(self):
+        self.connection.commit()
+        self.connection.close()
+
+    @staticmethod
+    def key(path):
+        stat = os.stat(path)
+        return (os.path.abspath(path), stat.st_size,
+                stat.st_mtime_ns, stat.st_ino)
+
+    def lookup(self, key):
+        query = """SELECT md5 FROM hashes
+                    WHERE path=? and bytes=? and mtime_ns=? and inode=?;"""
+        result = self.connection.execute(query, key).fetchone()
+        if result:
+            return result[0]
+        else:
+            return None
+
+    def store(self, key, md5):
+        query = """INSERT OR REPLACE INTO hashes
+                    (path, bytes, mtime_ns, inode, md5)
+                   VALUES (?, ?, ?, ?, ?);"""
+        self.connection.execute(query, (*key, md5))
+
+
+class PathTrie():
+    """
+    Prefix tree over the directory components of a set of paths, counting
+    the paths under each directory.  Used to find which of several
+    candidate paths sits best among the others in time proportional to
+    the length of the path.
+    """
+
+    __slots__ = ('count', 'children')
+
+    def __init__(self):
+        self.count = 0
+        self.children = {}
+
+    @staticmethod
+    def components(path):
+        return os.path.dirname(path).split(os.sep)
+
+    def add(self, path):
+        node = self
+        node.count += 1
+        for part in self.components(path):
+            child = node.children.get(part)
+            if child is None:
+                child = node.children[part] = PathTrie()
+            child.count += 1
+            node = child
+
+    def score(self, path):
+        """
+        Return (depth, count) for the deepest directory of path present in
+        the trie: how many leading components it shares with the indexed
+        paths, and how many of them share that prefix.
+        """
+        node = self
+        depth = 0
+        for part in self.components(path):
+            child = node.children.get(part)
+            if child is None:
+                break
+            node = child
+            depth += 1
+        return depth, node.count
+
+    def best(self, paths):
+        """Return the index of the best-placed path, the first on ties."""
+        best, best_score = 0, None
+        for n, path in enumerate(paths):
+            score = self.score(path)
+            if best_score is None or score > best_score:
+                best, best_score = n, score
+        return best
+
+    def branches(self):
+        """
+        Return a dict mapping each directory just below the point where
+        the indexed paths first diverge to the number of paths under it,
+        and the divergence point itself to the paths directly in it; empty
+        if they all share one directory.
+        """
+        node = self
+        parts = []
+        while len(node.children) == 1:
+            part, child = next(iter(node.children.items()))
+            if child.count != node.count:
+                break
+            parts.append(part)
+            node = child
+        prefix = os.sep.join(parts)
+        branches = {os.sep.join([prefix, part]): child.count
+                    for part, child in sorted(node.children.items())}
+        direct = node.count - sum(branches.values())
+        if branches and direct:
+            branches[prefix] = direct
+        return branches
+
+
+def calculate_md5(path, cache=None):
     """
     Calclulate and return the object's md5 hash.
     """
+    if cache is not None:
+        key = cache.key(path)
+        md5 = cache.lookup(key)
+        if md5 is not None:
+            return md5
     hash = hashlib.md5()
     with open(path, 'rb') as f:
         while True:
-            data = f.read(8192)
+            data = f.read(CHUNK_SIZE)
             if not data:
                 break
             else:
                 hash.update(data)
+    if cache is not None:
+        cache.store(key, hash.hexdigest())
     return hash.hexdigest()
 
 
+def hash_files(paths, cache=None, workers=8):
+    """
+    Return a dict mapping each path to its md5 hash.  Cached hashes are
+    reused; the remaining files are hashed concurrently in a thread pool.
+    """
+    results = {}
+    keys = {}
+    for path in paths:
+        if cache is not None:
+            keys[path] = cache.key(path)
+            md5 = cache.lookup(keys[path])
+            if md5 is not None:
+                results[path] = md5
+                continue
+        results[path] = None
+    pending = [path for path, md5 in results.items() if md5 is None]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for path, md5 in zip(pending, pool.map(calculate_md5, pending)):
+            results[path] = md5
+            if cache is not None:
+                cache.store(keys[path], md5)
+    return results
+
+
+def prefetch(function, items, max_in_flight=4):
+    """
+    Yield function(item) for each item, in order, while the results for up
+    to max_in_flight of the following items are computed in a thread pool.
+    Suits slow, I/O-bound loading of files: memory is bounded by the number
+    of results in flight.  With max_in_flight below 1 items are processed
+    one at a time, as map would.
+    """
+    if max_in_flight < 1:
+        yield from map(function, items)
+        return
+    items = iter(items)
+    with ThreadPoolExecutor(max_workers=max_in_flight) as pool:
+        pending = deque(pool.submit(function, item)
+                        for item in islice(items, max_in_flight))
+        while pending:
+            future = pending.popleft()
+            for item in islice(items, 1):
+                pending.append(pool.submit(function, item))
+            yield future.result()
+
+
+def read_text(path, encodings=('utf8', 'iso-8859-1', 'macroman'), md5=None):
+    """
+    Read a text file in a single pass, hashing its bytes as they are read
+    and then decoding the buffer with the first encoding that succeeds.
+    Return a tuple of (md5, handle, encoding), where handle is an in-memory
+    text stream reading as the file would in text mode; handle and encoding
+    are None if no encoding could decode the file.  If the file's md5 is
+    already known it can be passed in and hashing is skipped.
+    """
+    hash = hashlib.md5() if md5 is None else None
+    chunks = []
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(CHUNK_SIZE)
+            if not data:
+                break
+            else:
+                if hash is not None:
+                    hash.update(data)
+                chunks.append(data)
+    if hash is not None:
+        md5 = hash.hexdigest()
+    data = b''.join(chunks)
+    for encoding in encodings:
+        try:
+            text = data.decode(encoding)
+        except ValueError:
+            continue
+        return md5, io.StringIO(text, newline=None), encoding
+    return md5, None, None
+
+
+class LineReader():
+    """
+    Iterable over the stripped lines of a text file that never holds more
+    than one line in memory.  To decode the file exactly as read_text
+    would, its encoding is decided before any line is given out: the file
+    is read through once in chunks, hashing its bytes, and decoded with
+    each encoding in turn until one gets through the whole file.  A file
+    none of the encodings can decode raises ValueError.  md5, encoding and
+    lines are set as iteration goes.
+    """
+
+    def __init__(self, path, encodings=('utf8', 'iso-8859-1', 'macroman'),
+                 md5=None):
+        self.path = path
+        self.encodings = encodings
+        self.md5 = md5
+        self.encoding = None
+        self.lines = 0
+
+    def detect_encoding(self):
+        """
+        Return the first encoding that decodes the whole file, setting md5
+        on the first pass through it if it is not known.
+        """
+        hash = hashlib.md5() if self.md5 is None else None
+        for encoding in self.encodings:
+            decoder = codecs.getincrementaldecoder(encoding)()
+            with open(self.path, 'rb') as f:
+                while True:
+                    data = f.read(CHUNK_SIZE)
+                    if not data:
+                        break
+                    if hash is not None:
+                        hash.update(data)
+                    if decoder is not None:
+                        try:
+                            decoder.decode(data)
+                        except ValueError:
+                            decoder = None
+                            if hash is None:
+                                break
+            if decoder is not None:
+                try:
+                    decoder.decode(b'', final=True)
+                except ValueError:
+                    decoder = None
+            if hash is not None:
+                self.md5 = hash.hexdigest()
+                hash = None
+            if decoder is not None:
+                return encoding
+        raise ValueError(f'Could not decode {self.path}')
+
+    def __iter__(self):
+        self.lines = 0
+        self.encoding = self.detect_encoding()
+        with open(self.path, 'rb') as f:
+            for chunk in f:
+                # split on \r as well, as text mode's universal newlines do
+                for raw in chunk.splitlines():
+                    self.lines += 1
+                    yield raw.decode(self.encoding).strip()
+
+
+@contextmanager
+def atomic_write(path, mode='w', buffering=CHUNK_SIZE, newline=None):
+    """
+    Open a buffered temporary file next to path for writing, and move it
+    into place only once the block completes, so that path is never left
+    half written.  On error the temporary file is removed.
+    """
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.',
+                                     prefix=f'.{os.path.basename(path)}.')
+    try:
+        with open(fd, mode, buffering=buffering,
+                  newline=newline) as handle:
+            yield handle
+        os.chmod(temp_path, 0o666 & ~UMASK)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+
 def human_readable(bytes):
     """Return a human-readable representation of the input bytes."""
     for n, label in enumerate(['bytes', 'KiB', 'MiB', 'GiB', 'TiB']):
@@ -0,0 +1,283 @@
+from itertools import islice
+
+from . import accessions
+from .archiver import ActionSpool
+from .archiver import BatchSpool
+from .metrics import METRICS
+from .restores import Database
+from .restores import MatchIndex
+
+
+# Lookup backend of each worker process, opened by init_worker unless the
+# parent already built a match index that the workers inherit when forked
+worker_database = None
+
+# Number of the largest branches of a batch's restore paths listed in the
+# log
+LOGGED_BRANCHES = 10
+
+
+def open_database(path, use_index=False, readonly=False):
+    """Return the lookup backend for the restored files database."""
+    if use_index:
+        return MatchIndex.from_database(path)
+    else:
+        return Database(path, readonly=readonly)
+
+
+def init_worker(path, use_index):
+    """Open a read-only lookup backend for the current worker process."""
+    global worker_database
+    if worker_database is None:
+        worker_database = open_database(path, use_index, readonly=True)
+
+
+def load_batch(batchname, paths, hashes, stream=False, log=print):
+    """
+    Read the dirlists at paths and assemble them into a batch, reusing any
+    md5 hashes already known for them.  Streamed dirlists are only opened
+    here; their contents are read during verification.
+    """
+    log(f'\n{batchname.upper()}\n{"=" * len(batchname)}')
+    with METRICS.stage('parse'):
+        batch = accessions.Batch(batchname, *[
+            accessions.DirList(path, md5=hashes.get(path), stream=stream)
+            for path in paths
+            ], stream=stream)
+    METRICS.add('parse', items=batch.num_assets)
+    log(f"  Creating {batch.identifier}...")
+    log(f"  Source Files: {len(batch.dirlists)}")
+    if not stream:
+        log_dirlists(batch, log)
+    return batch
+
+
+def log_dirlists(batch, log=print):
+    for n, dirlist in enumerate(batch.dirlists, 1):
+        log(f"    ({n}) {dirlist.filename}: {dirlist.line_count} lines")
+    log(f"  Total Assets: {batch.num_assets}")
+
+
+def is_excluded(asset, exclude_patterns):
+    """True for excluded filenames and invisible files."""
+    return (asset.filename in exclude_patterns or
+            asset.filename.startswith('.'))
+
+
+def verify_batch(batch, database, exclude_patterns, log=print):
+    """
+    Match the assets of a batch against the restored files and classify
+    them, returning True if every asset in the batch was found.
+    """
+    # c. check for in-batch duplicate files
+    log(f"  Has duplicate files: {batch.has_duplicates()}")
+
+    # (4) Process assets
+    log(f"  Processing batch assets...")
+    candidates = []
+    for n, asset in enumerate(batch.assets, 1):
+        # a. skip excluded filenames and b. invisible files
+        if is_excluded(asset, exclude_patterns):
+            batch.classify(asset, 'Deaccession')
+        else:
+            candidates.append(asset)
+
+    # d. look for restored copies of the whole batch at once
+    with METRICS.stage('match', items=len(candidates)):
+        assets_with_duplicates = match_assets(batch, candidates, database)
+
+    if batch.statuses['Altered']:
+        log(f"  Altered files: {batch.statuses['Altered']}")
+
+    # if nothing in batch was found, abort here
+    if batch.all_have_status('NotFound'):
+        log(f'  No Assets in this batch were found. Skipping...')
+        return False
+
+    # Add "best match" duplicates to transfer batch
+    with METRICS.stage('resolve', items=len(assets_with_duplicates)):
+        resolve_duplicates(batch, assets_with_duplicates, log=log)
+
+    # Update batch status to reflect state of assets
+    if batch.all_have_status('Found'):
+        batch.status = 'Complete'
+        log(f"  Asset Root: {batch.asset_root}")
+        return True
+    else:
+        return False
+
+
+def match_assets(batch, candidates, database):
+    """
+    Classify candidate assets from a single lookup of the restored files
+    sharing their filename and bytes.  Assets with a copy of the same md5
+    (or with no md5 to compare) are found, setting the restored copy of
+    those with a single match and returning those with several; assets
+    whose copies all differ in md5 are altered; the rest are not found.
+    The copies of an asset are kept as its duplicates when there are
+    several to choose from or some of them are altered.
+    """
+    assets_with_duplicates = []
+    for asset, matches in zip(candidates, database.match_batch(candidates)):
+        perfect = matches
+        if matches and asset.md5 is not None:
+            perfect = [m for m in matches if m.md5 == asset.md5]
+            if len(perfect) < len(matches):
+                asset.duplicates = matches
+            if not perfect:
+                batch.classify(asset, 'Altered')
+                continue
+        if perfect:
+            batch.classify(asset, 'Found')
+            if len(perfect) == 1:
+                batch.restore(asset, perfect[0])
+            else:
+                asset.duplicates = matches
+                assets_with_duplicates.append(asset)
+        else:
+            batch.classify(asset, 'NotFound')
+    return assets_with_duplicates
+
+
+def resolve_duplicates(batch, assets_with_duplicates, log=print):
+    """
+    Pick the restored copy of each asset with several perfect matches: the
+    one sharing the longest directory prefix with the batch's single
+    matches, and among those the one in the most populated restore tree.
+    """
+    log(f"  Common Path: {batch.root}")
+    branches = batch.restore_paths.branches()
+    largest = sorted(branches.items(), key=lambda b: -b[1])[:LOGGED_BRANCHES]
+    for branch, count in largest:
+        log(f"    {branch}: {count}")
+    if len(branches) > LOGGED_BRANCHES:
+        log(f"    ... and {len(branches) - LOGGED_BRANCHES} more")
+    copies = [[c for c in asset.duplicates if not asset.is_altered(c)]
+              for asset in assets_with_duplicates]
+    choices = [batch.restore_paths.best([c.path for c in perfect])
+               for perfect in copies]
+    for asset, perfect, choice in zip(assets_with_duplicates, copies,
+                                      choices):
+        asset.extra_copies = [c for n, c in enumerate(perfect)
+                              if n != choice]
+        batch.restore(asset, perfect[choice])
+        log(asset.restored.path)
+        log([f.path for f in asset.extra_copies])
+
+
+def verify_stream(batch, database, exclude_patterns, spool_root,
+                  actions=False, chunk_size=50000, log=print):
+    """
+    Verify a streamed batch chunk by chunk, so that only one chunk of its
+    assets is in memory at a time.  Found assets go straight to a spool on
+    disk; only assets with several restored copies (resolved once the
+    common path of the batch is known) and those not found are kept.  If
+    actions are wanted, those of the assets not kept are spooled as well.
+    Return True if every asset in the batch was found.
+    """
+    log(f"  Processing batch assets...")
+    spool = BatchSpool(spool_root, batch.identifier)
+    if actions:
+        action_spool = ActionSpool(spool_root, batch.identifier)
+        batch.action_spool = action_spool.path
+        try:
+            return stream_assets(batch, database, exclude_patterns, spool,
+                                 action_spool, chunk_size, log)
+        finally:
+            action_spool.close()
+    return stream_assets(batch, database, exclude_patterns, spool, None,
+                         chunk_size, log)
+
+
+def stream_assets(batch, database, exclude_patterns, spool, action_spool,
+                  chunk_size, log):
+    assets_with_duplicates = []
+    assets = batch.iter_assets()
+    while True:
+        with METRICS.stage('parse'):
+            chunk = list(islice(assets, chunk_size))
+        if not chunk:
+            break
+        METRICS.add('parse', items=len(chunk))
+        candidates = []
+        for asset in chunk:
+            if is_excluded(asset, exclude_patterns):
+                batch.classify(asset, 'Deaccession')
+                if action_spool is not None:
+                    action_spool.write(asset)
+            else:
+                candidates.append(asset)
+        with METRICS.stage('match', items=len(candidates)):
+            duplicated = match_assets(batch, candidates, database)
+        assets_with_duplicates.extend(duplicated)
+        for asset in candidates:
+            if asset.status in ('NotFound', 'Altered'):
+                batch.assets.append(asset)
+            elif asset.restored is not None:
+                spool.write(asset)
+                if action_spool is not None:
+                    action_spool.write(asset)
+    log_dirlists(batch, log)
+    if batch.statuses['Altered']:
+        log(f"  Altered files: {batch.statuses['Altered']}")
+
+    # if nothing in batch was found, abort here
+    if batch.all_have_status('NotFound'):
+        log(f'  No Assets in this batch were found. Skipping...')
+        spool.discard()
+        return False
+
+    # Add "best match" duplicates to transfer batch
+    with METRICS.stage('resolve', items=len(assets_with_duplicates)):
+        resolve_duplicates(batch, assets_with_duplicates, log=log)
+    for asset in assets_with_duplicates:
+        spool.write(asset)
+        batch.assets.append(asset)
+
+    # Update batch status to reflect state of assets
+    if batch.all_have_status('Found'):
+        batch.status = 'Complete'
+        spool.close()
+        batch.spool = spool.path
+        log(f"  Asset Root: {batch.asset_root}")
+        return True
+    else:
+        spool.discard()
+        return False
+
+
+def load_item(item, log=print):
+    """Load the batch of a work item."""
+    batchname, paths, hashes, exclude_patterns, spool_root, actions = item
+    return load_batch(batchname, paths, hashes,
+                      stream=spool_root is not None, log=log)
+
+
+def run_batch(item, database, log=print, batch=None):
+    """
+    Load and verify one batch, returning it with its completion state.
+    A batch already loaded from the item can be passed in.
+    """
+    batchname, paths, hashes, exclude_patterns, spool_root, actions = item
+    stream = spool_root is not None
+    if batch is None:
+        batch = load_item(item, log=log)
+    if stream:
+        complete = verify_stream(batch, database, exclude_patterns,
+                                 spool_root, actions=actions, log=log)
+    else:
+        complete = verify_batch(batch, database, exclude_patterns, log=log)
+    for dirlist in batch.dirlists:
+        dirlist.release()
+    return batch, complete
+
+
+def run_batch_in_worker(item):
+    """
+    Worker-process entry point; returns the batch, its log output and the
+    metrics gathered while verifying it.
+    """
+    messages = []
+    METRICS.reset()
+    batch, complete = run_batch(item, worker_database, log=messages.append)
+    return batch, complete, messages, METRICS